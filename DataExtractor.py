@@ -1,99 +1,149 @@
-import requests
-import json
-import time 
 import os
 from tqdm import tqdm
 
+from fetch_engine import RawFileFetcher, default_rate_limiter, RAW_BASE_URL, DEFAULT_REQUESTS_PER_HOUR
+from git_extractor import GitFetcher
+from file_cache import FileCache, DEFAULT_CACHE_DIR, DEFAULT_MAX_BYTES
+from storage import JsonlWriter, jsonl_path_for, compact_jsonl, export_json_array
+from telemetry import span
+
 
 TOKEN = os.getenv("GITHUB_TOKEN")
 
-def fetch_code_snippet(repo_url, commit_hash, file_path, start_line, end_line, request_count):
-
-    if request_count > 4500:
-        print("Reached 4500 requests, sleeping for 1 hour ...")
-        time.sleep(3600)
-        request_count = 0
-
-
-    repo_name = repo_url.split('github.com:')[-1].replace('.git', '')
-    
-    raw_url = f"https://raw.githubusercontent.com/{repo_name}/{commit_hash}/{file_path.lstrip('/')}"
-
-    headers = {'Authorization': f'token {TOKEN}'}
-    
-    response = requests.get(raw_url, headers=headers)
-    
-    if response.status_code == 200:
-        lines = response.text.splitlines()
-        
-        code_snippet = "\n".join(lines[start_line-1:end_line])
-        
-        return code_snippet, request_count + 1
-    else:
-        print(f"Failed to fetch code from {raw_url} (status code: {response.status_code})")
-        return None, request_count + 1 
-    
-
-def process_csv_and_save_to_json(csv_file, json_file,batch_size=50):
-    
-    request_count = 0
+def repo_name_from_url(repo_url):
+    return repo_url.split('github.com:')[-1].replace('.git', '')
+
+
+def slice_lines(text, start_line, end_line):
+    lines = text.splitlines()
+    return "\n".join(lines[start_line-1:end_line])
+
+
+def parse_csv_line(i, line):
+    parts = line.strip().split(";")
+    _, _, _, smell, severity, _, type, code_name, repo_url, commit_hash, file_path, start_line, end_line, _, _ = parts
+
+    return {
+        "id": i,
+        "repo_url": repo_url,
+        "commit_hash": commit_hash,
+        "file_path": file_path,
+        "start_line": int(start_line),
+        "end_line": int(end_line),
+        "smell": smell,
+        "severity": severity
+    }
+
+
+def iter_csv_rows(f):
+    next(f)
+    for i, line in enumerate(f):
+        yield parse_csv_line(i, line)
+
+
+def group_rows_by_file(rows):
+    """Group rows pointing at the same file at the same commit.
+
+    Groups are ordered by repository and commit (first-seen order otherwise),
+    so a local git backend reads each commit's files one after the other.
+    """
+    groups = {}
+    for row in rows:
+        key = (repo_name_from_url(row["repo_url"]), row["commit_hash"], row["file_path"])
+        groups.setdefault(key, []).append(row)
+    return dict(sorted(groups.items(), key=lambda item: item[0][:2]))
+
+
+def fetch_rows(rows, fetcher, cache=None):
+    """Yield (row, snippet) pairs, downloading each distinct file only once."""
+
+    def fetch(item):
+        (repo_name, commit_hash, file_path), group = item
+        text = cache.get(repo_name, commit_hash, file_path) if cache else None
+        if text is None:
+            with span("fetch", file=f"{repo_name}/{file_path}") as attrs:
+                text = fetcher.fetch_file(repo_name, commit_hash, file_path)
+                attrs["bytes"] = len(text) if text is not None else 0
+            if text is not None and cache is not None:
+                cache.put(repo_name, commit_hash, file_path, text)
+        if text is None:
+            return [(row, None) for row in group]
+        return [(row, slice_lines(text, row["start_line"], row["end_line"])) for row in group]
+
+    for fetched in fetcher.map(fetch, group_rows_by_file(rows).items()):
+        yield from fetched
+
+
+def make_fetcher(concurrency=1, requests_per_hour=DEFAULT_REQUESTS_PER_HOUR, base_url=RAW_BASE_URL,
+                 mirrors_dir=None, fallback_to_http=True):
+    """HTTP fetcher, or with `mirrors_dir` a local git one falling back to HTTP for what is missing."""
+    http_fetcher = None
+    if mirrors_dir is None or fallback_to_http:
+        http_fetcher = RawFileFetcher(token=TOKEN, concurrency=concurrency, base_url=base_url,
+                                      rate_limiter=default_rate_limiter(requests_per_hour))
+    if mirrors_dir is None:
+        return http_fetcher
+    return GitFetcher(mirrors_dir, fallback=http_fetcher)
+
+
+def process_csv_and_save_to_json(csv_file, json_file, batch_size=50, concurrency=1,
+                                 requests_per_hour=DEFAULT_REQUESTS_PER_HOUR, base_url=RAW_BASE_URL,
+                                 cache_dir=DEFAULT_CACHE_DIR, cache_max_bytes=DEFAULT_MAX_BYTES,
+                                 mirrors_dir=None, fallback_to_http=True):
+    """Fetch every snippet referenced by the CSV and append them to `json_file`.
+
+    Files are downloaded by `concurrency` threads over a pooled session, throttled by
+    a token bucket that follows GitHub's rate-limit headers. `base_url` can point at
+    a local stand-in for raw.githubusercontent.com.
+
+    Rows are grouped by file so each (repo, commit, path) is fetched once, and raw
+    files are kept in an on-disk LRU cache under `cache_dir` (disabled with None).
+    Snippets are therefore written grouped by file rather than in CSV order.
+
+    With `mirrors_dir`, files are read from local clones or bare mirrors with
+    `git cat-file --batch`, and only those missing locally are downloaded (not at
+    all without `fallback_to_http`).
+
+    Batches are appended to a JSONL file next to `json_file`, which is compacted
+    and exported as the JSON array `json_file` once every row has been processed.
+    """
     json_data = []
     counter = 0
 
-    with open(csv_file, 'r') as f:
-        
-        next(f)
-
-        for i, line in tqdm(enumerate(f), desc="Fetching code snippets"):
-            parts = line.strip().split(";")
-            _, _, _, smell, severity, _, type, code_name, repo_url, commit_hash, file_path, start_line, end_line, _, _ = parts
-            
-            start_line = int(start_line)
-            end_line = int(end_line)
-            
-            code_snippet, request_count = fetch_code_snippet(repo_url, commit_hash, file_path, start_line, end_line, request_count)
-            
+    fetcher = make_fetcher(concurrency, requests_per_hour, base_url, mirrors_dir, fallback_to_http)
+    # Local repositories are as fast as the cache and already hold every file.
+    cache = FileCache(cache_dir, cache_max_bytes) if cache_dir and not mirrors_dir else None
+
+    jsonl_file = jsonl_path_for(json_file)
+
+    with open(csv_file, 'r') as f, JsonlWriter(jsonl_file) as writer:
+
+        fetched = fetch_rows(iter_csv_rows(f), fetcher, cache)
+
+        for row, code_snippet in tqdm(fetched, desc="Fetching code snippets"):
             if code_snippet:
-                json_data.append({
-                    "id": i,
-                    "repo_url": repo_url,
-                    "commit_hash": commit_hash,
-                    "file_path": file_path,
-                    "start_line": start_line,
-                    "end_line": end_line,
-                    "code_snippet": code_snippet,
-                    "smell": smell,
-                    "severity": severity
-                })
+                json_data.append({**row, "code_snippet": code_snippet})
 
             counter += 1 
             if counter % batch_size == 0:
-                save_json_data(json_file, json_data)
+                writer.write_batch(json_data)
                 json_data = []
 
-        if json_data:
-            save_json_data(json_file, json_data)
-        print(f"Completed processing. Data saved to {json_file}")
-    
-    
-def save_json_data(json_file, json_data):
-
-    try:
-        with open(json_file, 'r') as f:
-            existing_data = json.load(f)
-    except (FileNotFoundError, json.JSONDecodeError):
-        existing_data = []
-
-    existing_data.extend(json_data)
+        writer.write_batch(json_data)
 
-    with open(json_file, 'w') as f:
-        json.dump(existing_data, f, indent=4)
+    fetcher.close()
+    if cache is not None:
+        print(f"File cache: {cache.hits} hits, {cache.misses} misses")
 
-    print(f"Saved batch of {len(json_data)} entries to {json_file}")
+    count = compact_jsonl(jsonl_file, key="id")
+    export_json_array(jsonl_file, json_file)
+    print(f"Completed processing. {count} entries saved to {json_file}")
 
 
 if __name__ == '__main__':
 
     csv_file = "MLCQCodeSmellSamples.csv"
     json_file = "MLCQCodeSmellSamples.json"
-    process_csv_and_save_to_json(csv_file, json_file)
+    concurrency = int(os.getenv("FETCH_CONCURRENCY", "8"))
+    mirrors_dir = os.getenv("GIT_MIRRORS_DIR")
+    process_csv_and_save_to_json(csv_file, json_file, concurrency=concurrency, mirrors_dir=mirrors_dir)
@@ -0,0 +1,390 @@
+"""End-to-end benchmark of the pipeline on a synthetic corpus, without GitHub, OpenAI or a GPU.
+
+A deterministic MLCQ-style corpus (CSV + Java files + extracted JSON dataset) is
+generated in a work directory, raw files are served by a local stand-in of
+raw.githubusercontent.com, GPT-4 by a mock chat completions server with
+injectable latency and 429s, and llama.py runs a tiny randomly initialised
+Llama model built on the spot. Each stage runs in its own process so that its
+peak RSS is measured in isolation.
+
+    python benchmark.py --size 2000
+    python benchmark.py --stages gpt4 --latency 0.2 --error-rate 0.02 --concurrency 16
+"""
+import argparse
+import functools
+import inspect
+import json
+import logging
+import multiprocessing
+import os
+import queue
+import random
+import resource
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+from mock_servers import RawFileServer, ChatCompletionsServer, ANSWERS
+
+logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(message)s")
+
+STAGES = ("extract", "gpt4", "llama", "metrics")
+
+CSV_HEADER = ("id;reviewer_id;sample_id;smell;severity;review_timestamp;type;code_name;repository;commit_hash;"
+              "path;start_line;end_line;link;is_from_industry_relevant_project")
+SMELLS = ["blob", "data class", "feature envy", "long method"]
+SEVERITIES = ["none", "minor", "moderate", "severe"]
+
+# Prompt text the tiny model's tokenizer is trained on, next to the corpus itself.
+TOKENIZER_EXTRA_TEXT = ANSWERS + ["You are a code smell detector. Severity none minor moderate severe"]
+
+
+def java_method(rng, name, length):
+    lines = [f"    public int {name}(int value) {{"]
+    for i in range(length):
+        lines.append(f"        value = value * {rng.randint(2, 9)} + field{rng.randint(0, 5)}; // step {i}")
+    lines.append("        return value;")
+    lines.append("    }")
+    return lines
+
+
+def java_class(rng, package, name, methods):
+    """Java source of a class and the (start_line, end_line) range of each of its methods."""
+    lines = [f"package {package};", "", f"public class {name} {{"]
+    lines += [f"    private int field{i};" for i in range(6)]
+    ranges = []
+    for i in range(methods):
+        lines.append("")
+        method = java_method(rng, f"method{i}", rng.randint(2, 40))
+        ranges.append((len(lines) + 1, len(lines) + len(method)))
+        lines += method
+    lines.append("}")
+    return "\n".join(lines) + "\n", (1, len(lines)), ranges
+
+
+def generate_corpus(directory, size, rows_per_file=3, repos=20, seed=0):
+    """Write a synthetic MLCQ CSV and the dataset DataExtractor would build from it.
+
+    Returns the paths and the served files as a dict of "owner/repo/commit/path" to
+    text, the layout of the raw endpoint. Rows point at whole classes (blob, data
+    class) or single methods (long method, feature envy); several rows share each
+    file, as in MLCQ where a file is reviewed more than once.
+    """
+    rng = random.Random(seed)
+    files = {}
+    records = []
+    csv_lines = [CSV_HEADER]
+    commits = [f"{rng.getrandbits(160):040x}" for _ in range(repos)]
+
+    file_index = 0
+    while len(records) < size:
+        repo = file_index % repos
+        repo_name = f"org{repo}/project{repo}"
+        path = f"src/main/java/org/project{repo}/Class{file_index}.java"
+        text, class_range, method_ranges = java_class(rng, f"org.project{repo}", f"Class{file_index}",
+                                                      rng.randint(1, 8))
+        files[f"{repo_name}/{commits[repo]}/{path}"] = text
+        lines = text.splitlines()
+
+        for _ in range(min(rows_per_file, size - len(records))):
+            smell = rng.choice(SMELLS)
+            severity = rng.choice(SEVERITIES)
+            start_line, end_line = class_range if smell in ("blob", "data class") else rng.choice(method_ranges)
+            row_id = len(records)
+            csv_lines.append(";".join(map(str, [
+                row_id, rng.randint(1, 30), rng.randint(1, 5000), smell, severity, "2019-01-01 00:00:00",
+                "class" if smell in ("blob", "data class") else "function", f"org.project{repo}.Class{file_index}",
+                f"git@github.com:{repo_name}.git", commits[repo], path, start_line, end_line,
+                f"https://github.com/{repo_name}/blob/{commits[repo]}/{path}", rng.random() < 0.5,
+            ])))
+            records.append({
+                "unique_id": row_id,
+                "smell": smell,
+                "severity": severity,
+                "code_snippet": "\n".join(lines[start_line - 1:end_line]),
+            })
+        file_index += 1
+
+    paths = {"csv": os.path.join(directory, "corpus.csv"), "dataset": os.path.join(directory, "dataset.json")}
+    with open(paths["csv"], "w") as f:
+        f.write("\n".join(csv_lines) + "\n")
+    with open(paths["dataset"], "w") as f:
+        json.dump(records, f)
+    return paths, files, records
+
+
+def generate_results(directory, records, runs, seed=0):
+    """Random model outputs for `records`, one results file per run, to feed compute_metrics."""
+    rng = random.Random(seed)
+    paths = []
+    for run in range(runs):
+        path = os.path.join(directory, f"results{run}.json")
+        with open(path, "w") as f:
+            json.dump([{"unique_id": record["unique_id"], "smell_and_severity": rng.choice(ANSWERS)}
+                       for record in records], f)
+        paths.append(path)
+    return paths
+
+
+def build_tiny_model(directory, texts, vocab_size=1000, context_window=4096):
+    """Save a randomly initialised two-layer Llama and a BPE tokenizer trained on `texts`."""
+    from tokenizers import Tokenizer, models, pre_tokenizers, decoders, trainers
+    from transformers import PreTrainedTokenizerFast, LlamaConfig, LlamaForCausalLM
+
+    tokenizer = Tokenizer(models.BPE(unk_token="<unk>"))
+    tokenizer.pre_tokenizer = pre_tokenizers.ByteLevel(add_prefix_space=False)
+    tokenizer.decoder = decoders.ByteLevel()
+    trainer = trainers.BpeTrainer(vocab_size=vocab_size, special_tokens=["<unk>", "<s>", "</s>"],
+                                  initial_alphabet=pre_tokenizers.ByteLevel.alphabet())
+    tokenizer.train_from_iterator(texts, trainer)
+    tokenizer = PreTrainedTokenizerFast(tokenizer_object=tokenizer, bos_token="<s>", eos_token="</s>",
+                                        unk_token="<unk>")
+    tokenizer.save_pretrained(directory)
+
+    config = LlamaConfig(vocab_size=len(tokenizer), hidden_size=64, intermediate_size=128, num_hidden_layers=2,
+                         num_attention_heads=4, num_key_value_heads=4, max_position_embeddings=context_window,
+                         bos_token_id=tokenizer.bos_token_id, eos_token_id=tokenizer.eos_token_id)
+    LlamaForCausalLM(config).save_pretrained(directory)
+    return directory
+
+
+def timed(owner, name, samples):
+    """Replace `owner.name` by a wrapper appending the duration of every call to `samples`."""
+    fn = getattr(owner, name)
+
+    if inspect.iscoroutinefunction(fn):
+        @functools.wraps(fn)
+        async def wrapper(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return await fn(*args, **kwargs)
+            finally:
+                samples.append(time.perf_counter() - start)
+    else:
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return fn(*args, **kwargs)
+            finally:
+                samples.append(time.perf_counter() - start)
+
+    setattr(owner, name, wrapper)
+
+
+def peak_rss_bytes():
+    # ru_maxrss survives exec on Linux, so a spawned process would report its parent's peak.
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports kilobytes, macOS bytes.
+    return peak if sys.platform == "darwin" else peak * 1024
+
+
+def fresh_output(path):
+    """Delete a stage's output and its JSONL log, so a re-run in the same workdir does not just resume."""
+    from storage import jsonl_path_for
+    for stale in (path, jsonl_path_for(path)):
+        if os.path.exists(stale):
+            os.remove(stale)
+    return path
+
+
+def count_records(path):
+    from dataset import iter_records
+    return sum(1 for _ in iter_records(path))
+
+
+def run_extract(config, samples):
+    import fetch_engine
+    import DataExtractor
+    timed(fetch_engine.RawFileFetcher, "fetch_file", samples)
+    output = fresh_output("extracted.json")
+    DataExtractor.process_csv_and_save_to_json(config["csv"], output, concurrency=config["concurrency"],
+                                               requests_per_hour=10 ** 9, base_url=config["raw_url"],
+                                               cache_dir=None)
+    return count_records(output)
+
+
+def run_gpt4(config, samples):
+    os.environ["OPENAI_BASE_URL"] = config["openai_url"]
+    os.environ.setdefault("OPENAI_API_KEY", "benchmark")
+    import gpt4
+    timed(gpt4, "request_completion", samples)
+    output = fresh_output("gpt4_results.json")
+    gpt4.process_json(config["dataset"], output, concurrency=config["concurrency"],
+                      chunk=config["chunk"], use_cache=False)
+    return count_records(output)
+
+
+def run_llama(config, samples):
+    os.environ["LLAMA_CONTEXT_WINDOW"] = str(config["context_window"])
+    import torch
+    import llama
+    torch.set_num_threads(config["threads"])
+    llama.load_pipeline(config["model"])
+    timed(llama, "detect_smell_and_severity_batch", samples)
+    output = fresh_output("llama_results.json")
+    llama.process_json(config["dataset"], output, inference_batch_size=config["batch_size"],
+                       chunk=config["chunk"], use_cache=False, constrained=config["constrained"])
+    return count_records(output)
+
+
+def run_metrics(config, samples):
+    import compute_metrics
+    timed(compute_metrics, "evaluate", samples)
+    compute_metrics.evaluate_runs(config["dataset"], config["results"], config["bootstrap"])
+    return config["size"] * len(config["results"])
+
+
+# Stage runner and what one latency sample measures.
+STAGE_RUNNERS = {
+    "extract": (run_extract, "file fetch"),
+    "gpt4": (run_gpt4, "request"),
+    "llama": (run_llama, "window"),
+    "metrics": (run_metrics, "result file"),
+}
+
+
+def stage_process(stage, config, results):
+    os.chdir(config["workdir"])
+    if not config["verbose"]:
+        # The scripts log every snippet at INFO, which would dominate the timings.
+        logging.disable(logging.INFO)
+        os.environ["TQDM_DISABLE"] = "1"
+    samples = []
+    start = time.perf_counter()
+    items = STAGE_RUNNERS[stage][0](config, samples)
+    results.put({"stage": stage, "items": items, "seconds": time.perf_counter() - start,
+                 "samples": samples, "peak_rss": peak_rss_bytes()})
+
+
+def run_stage(stage, config):
+    """Run one stage in a fresh process and summarise its throughput, latency and memory."""
+    context = multiprocessing.get_context("spawn")
+    results = context.Queue()
+    process = context.Process(target=stage_process, args=(stage, config, results))
+    process.start()
+    # Read the result before joining: the child cannot exit until the queue's
+    # pipe is drained, which a large latency sample list would otherwise fill.
+    result = None
+    while result is None:
+        try:
+            result = results.get(timeout=1)
+        except queue.Empty:
+            if not process.is_alive():
+                break
+    process.join()
+    if result is None or process.exitcode != 0:
+        logging.error(f"Stage {stage} failed with exit code {process.exitcode}")
+        return None
+
+    samples = np.array(result["samples"]) * 1000
+    return {
+        "stage": stage,
+        "items": result["items"],
+        "seconds": result["seconds"],
+        "items_per_second": result["items"] / result["seconds"],
+        "latency_unit": STAGE_RUNNERS[stage][1],
+        "calls": int(len(samples)),
+        "p50_ms": float(np.percentile(samples, 50)) if len(samples) else None,
+        "p99_ms": float(np.percentile(samples, 99)) if len(samples) else None,
+        "peak_rss_mb": result["peak_rss"] / 2 ** 20,
+    }
+
+
+def log_summary(summaries):
+    logging.info(f"{'stage':<8} {'items':>7} {'seconds':>9} {'items/s':>10} {'p50 ms':>9} {'p99 ms':>9} "
+                 f"{'peak RSS MB':>12}  latency per")
+    for s in summaries:
+        p50 = f"{s['p50_ms']:.1f}" if s["p50_ms"] is not None else "-"
+        p99 = f"{s['p99_ms']:.1f}" if s["p99_ms"] is not None else "-"
+        logging.info(f"{s['stage']:<8} {s['items']:>7} {s['seconds']:>9.2f} {s['items_per_second']:>10.1f} "
+                     f"{p50:>9} {p99:>9} {s['peak_rss_mb']:>12.1f}  {s['latency_unit']}")
+
+
+def run_benchmark(stages=STAGES, size=500, workdir=None, concurrency=8, latency=0.05, error_rate=0.0,
+                  max_concurrency=None, fetch_latency=0.0, model=None, batch_size=8, context_window=4096,
+                  threads=None, constrained=False, chunk=False, runs=3, bootstrap=1000, verbose=False, seed=0):
+    """Generate the corpus, start the mock servers and run each requested stage."""
+    workdir = workdir or tempfile.mkdtemp(prefix="mlcq_bench_")
+    os.makedirs(workdir, exist_ok=True)
+    logging.info(f"Generating {size} synthetic samples in {workdir}")
+    paths, files, records = generate_corpus(workdir, size, seed=seed)
+
+    config = {
+        "workdir": workdir,
+        "size": size,
+        "csv": paths["csv"],
+        "dataset": paths["dataset"],
+        "concurrency": concurrency,
+        "chunk": chunk,
+        "constrained": constrained,
+        "batch_size": batch_size,
+        "context_window": context_window,
+        "threads": threads or os.cpu_count(),
+        "bootstrap": bootstrap,
+        "verbose": verbose,
+    }
+    if "llama" in stages:
+        config["model"] = model or build_tiny_model(os.path.join(workdir, "tiny-llama"),
+                                                    [record["code_snippet"] for record in records]
+                                                    + TOKENIZER_EXTRA_TEXT,
+                                                    context_window=context_window)
+    if "metrics" in stages:
+        config["results"] = generate_results(workdir, records, runs, seed=seed)
+
+    summaries = []
+    with RawFileServer(files, latency=fetch_latency) as raw_server, \
+            ChatCompletionsServer(latency, error_rate, max_concurrency, seed=seed) as chat_server:
+        config["raw_url"] = raw_server.url
+        config["openai_url"] = chat_server.base_url
+        for stage in stages:
+            logging.info(f"Running stage {stage}")
+            summary = run_stage(stage, config)
+            if summary is not None:
+                summaries.append(summary)
+        if "gpt4" in stages:
+            logging.info(f"Mock API answered {chat_server.requests} requests, {chat_server.rate_limited} with 429")
+    return summaries
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the pipeline end to end on synthetic data")
+    parser.add_argument("--stages", nargs="+", choices=STAGES, default=list(STAGES))
+    parser.add_argument("--size", type=int, default=500, help="Number of synthetic samples")
+    parser.add_argument("--workdir", default=None, help="Where to write the corpus and outputs (default: a temp dir)")
+    parser.add_argument("--concurrency", type=int, default=8, help="Fetch threads and requests in flight")
+    parser.add_argument("--fetch-latency", type=float, default=0.0, help="Seconds per raw file request")
+    parser.add_argument("--latency", type=float, default=0.05, help="Mean seconds per chat completion")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="Fraction of chat requests answered with 429")
+    parser.add_argument("--max-concurrency", type=int, default=None,
+                        help="Answer 429 when more chat requests than this are in flight")
+    parser.add_argument("--model", default=None, help="Local model for the llama stage (default: build a tiny one)")
+    parser.add_argument("--batch-size", type=int, default=8, help="Generation batch size for the llama stage")
+    parser.add_argument("--context-window", type=int, default=4096, help="Context window for the llama stage")
+    parser.add_argument("--threads", type=int, default=None, help="Torch threads for the llama stage")
+    parser.add_argument("--constrained", action="store_true", help="Score the valid answers in the llama stage")
+    parser.add_argument("--chunk", action="store_true", help="Split oversized snippets in the inference stages")
+    parser.add_argument("--runs", type=int, default=3, help="Result files scored by the metrics stage")
+    parser.add_argument("--bootstrap", type=int, default=1000, help="Bootstrap replicates in the metrics stage")
+    parser.add_argument("--output", default=None, help="Also write the summary to this JSON file")
+    parser.add_argument("--verbose", action="store_true", help="Keep the scripts' own logging and progress bars")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    summaries = run_benchmark(args.stages, args.size, args.workdir, args.concurrency, args.latency, args.error_rate,
+                              args.max_concurrency, args.fetch_latency, args.model, args.batch_size,
+                              args.context_window, args.threads, args.constrained, args.chunk, args.runs,
+                              args.bootstrap, args.verbose, args.seed)
+    log_summary(summaries)
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(summaries, f, indent=4)
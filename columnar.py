@@ -0,0 +1,163 @@
+"""Columnar copy of the dataset: labels as small integer columns, snippets in one memory-mapped blob.
+
+`MLCQCodeSmellSamples.json` repeats every label, repository URL, commit and path
+as a string in each record, and reading it means parsing all the snippets. The
+store built by `python columnar.py MLCQCodeSmellSamples.json` is a directory
+holding:
+
+- meta.json: the row count, the columns and the categories of each
+  dictionary-encoded column,
+- <column>.npy: one array per column, integer values as is and strings (smell,
+  severity, repo_url, ...) as codes into their categories,
+- id_index.npy: the row of each unique_id, for O(1) lookups,
+- snippets.bin and snippet_offsets.npy: the UTF-8 snippets back to back and
+  where each one starts.
+
+Everything is memory-mapped, so opening the store costs next to nothing and
+only the rows and snippets actually read are paged in. Every script taking a
+dataset (`--input`) accepts the store's directory in place of the JSON file.
+"""
+import argparse
+import json
+import logging
+import os
+
+import numpy as np
+
+from dataset import iter_records, in_shard, normalize_label
+
+META_FILE = "meta.json"
+SNIPPETS_FILE = "snippets.bin"
+
+
+def is_columnar(path):
+    return os.path.isdir(path) and os.path.isfile(os.path.join(path, META_FILE))
+
+
+def default_store_path(dataset_path):
+    return os.path.splitext(dataset_path)[0] + ".columns"
+
+
+def code_dtype(size):
+    return np.int8 if size <= 127 else np.int16 if size <= 32767 else np.int32
+
+
+def convert(dataset_path, store_path=None):
+    """Write the records of a JSON array or JSONL dataset as a columnar store; returns its path."""
+    store_path = store_path or default_store_path(dataset_path)
+    os.makedirs(store_path, exist_ok=True)
+    ids, columns, offsets = [], {}, [0]
+    with open(os.path.join(store_path, SNIPPETS_FILE), "wb") as blob:
+        for row, record in enumerate(iter_records(dataset_path)):
+            unique_id = record.pop("unique_id")
+            record.pop("id", None)
+            if not isinstance(unique_id, int) or unique_id < 0:
+                raise ValueError(f"The columnar store needs non-negative integer unique ids, got {unique_id!r}")
+            ids.append(unique_id)
+            offsets.append(offsets[-1] + blob.write((record.pop("code_snippet", None) or "").encode("utf-8")))
+            for name in list(columns) + [name for name in record if name not in columns]:
+                columns.setdefault(name, [None] * row).append(record.get(name))
+
+    meta = {"count": len(ids), "columns": {}}
+    for name, values in columns.items():
+        if all(type(value) is int for value in values):
+            np.save(os.path.join(store_path, f"{name}.npy"), np.array(values, dtype=np.int64))
+            meta["columns"][name] = None
+        else:
+            categories = sorted(set(values), key=lambda value: (value is None, str(value)))
+            codes = {category: code for code, category in enumerate(categories)}
+            np.save(os.path.join(store_path, f"{name}.npy"),
+                    np.array([codes[value] for value in values], dtype=code_dtype(len(categories))))
+            meta["columns"][name] = categories
+
+    ids = np.array(ids, dtype=np.int64)
+    id_index = np.full(int(ids.max()) + 1 if len(ids) else 0, -1, dtype=np.int64)
+    if len(np.unique(ids)) != len(ids):
+        raise ValueError("The columnar store needs unique ids")
+    id_index[ids] = np.arange(len(ids))
+    np.save(os.path.join(store_path, "unique_id.npy"), ids)
+    np.save(os.path.join(store_path, "id_index.npy"), id_index)
+    np.save(os.path.join(store_path, "snippet_offsets.npy"), np.array(offsets, dtype=np.int64))
+    with open(os.path.join(store_path, META_FILE), "w") as f:
+        json.dump(meta, f, indent=1)
+    logging.info(f"Wrote {len(ids)} records with columns {', '.join(meta['columns'])} to {store_path}")
+    return store_path
+
+
+class ColumnarDataset:
+    """Read access to a store written by `convert`.
+
+    Rows are numbered in dataset order; `get(unique_id)` gives the row of an id.
+    """
+
+    def __init__(self, store_path):
+        with open(os.path.join(store_path, META_FILE), "r") as f:
+            meta = json.load(f)
+        self.categories = meta["columns"]
+
+        def load(name):
+            return np.load(os.path.join(store_path, f"{name}.npy"), mmap_mode="r")
+
+        self.columns = {name: load(name) for name in self.categories}
+        self.ids = load("unique_id")
+        self.id_index = load("id_index")
+        self.offsets = load("snippet_offsets")
+        # np.memmap cannot map an empty file.
+        self.snippets = (np.memmap(os.path.join(store_path, SNIPPETS_FILE), dtype=np.uint8, mode="r")
+                         if self.offsets[-1] else np.zeros(0, dtype=np.uint8))
+
+    def __len__(self):
+        return len(self.ids)
+
+    def get(self, unique_id, default=None):
+        """Row of `unique_id`, or `default` when the store has no such id."""
+        if not isinstance(unique_id, (int, np.integer)) or not 0 <= unique_id < len(self.id_index):
+            return default
+        row = int(self.id_index[unique_id])
+        return default if row < 0 else row
+
+    def value(self, name, row):
+        value = self.columns[name][row]
+        categories = self.categories[name]
+        return int(value) if categories is None else categories[value]
+
+    def snippet(self, row):
+        return bytes(self.snippets[self.offsets[row]:self.offsets[row + 1]]).decode("utf-8")
+
+    def record(self, row):
+        record = {"unique_id": int(self.ids[row])}
+        record.update((name, self.value(name, row)) for name in self.columns)
+        record["code_snippet"] = self.snippet(row)
+        return record
+
+    def label_mask(self, name, labels):
+        """Rows whose `name` column holds one of `labels`, compared like dataset.iter_records does."""
+        labels = {normalize_label(label) for label in labels}
+        wanted = [code for code, category in enumerate(self.categories[name])
+                  if category is not None and normalize_label(category) in labels]
+        return np.isin(self.columns[name], wanted)
+
+    def iter_records(self, shard=None, smells=None, severities=None):
+        """Records in dataset order, filtered like dataset.iter_records.
+
+        The label filters run on the codes, so skipped rows never have their
+        snippet read.
+        """
+        mask = np.ones(len(self), dtype=bool)
+        if smells:
+            mask &= self.label_mask("smell", smells)
+        if severities:
+            mask &= self.label_mask("severity", severities)
+        for row in np.flatnonzero(mask):
+            if shard is not None and not in_shard(int(self.ids[row]), shard):
+                continue
+            yield self.record(row)
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(message)s")
+    parser = argparse.ArgumentParser(description="Convert a JSON or JSONL dataset into a columnar store")
+    parser.add_argument("input", nargs="?", default="MLCQCodeSmellSamples.json")
+    parser.add_argument("--output", default=None, help="Store directory (default: <input>.columns)")
+    args = parser.parse_args()
+    convert(args.input, args.output)
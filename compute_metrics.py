@@ -1,10 +1,33 @@
+import argparse
 import json
 import logging
+import re
 from collections import defaultdict
-from sklearn.metrics import precision_recall_fscore_support
+
+import numpy as np
+
+from columnar import is_columnar, ColumnarDataset
+from dataset import iter_records
+from telemetry import span, configure, add_telemetry_arguments
 
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 
+SMELLS = ['data class', 'long method', 'feature envy', 'blob']
+SEVERITIES = ['none', 'minor', 'moderate', 'severe']
+
+# Class 0 is "no smell" (severity none), classes 1..4 follow SMELLS.
+LABELS = ['none'] + SMELLS
+NO_SMELL = 0
+INVALID = -1
+
+# Self-consistency runs are split by the share of samples agreeing with the answer.
+AGREEMENT_EDGES = [0.5, 0.75, 1.0]
+AGREEMENT_LABELS = ['< 50%', '50-75%', '75-100%', 'unanimous']
+
+SMELL_PATTERN = re.compile(r'data class|long method|feature envy|blob')
+# One "smell: X, severity: Y" verdict per line, in either order.
+VERDICT_PATTERN = re.compile(r'smell:([^,\n]*),[^\n]*?severity:([^,\n]*)|severity:([^,\n]*),[^\n]*?smell:([^,\n]*)')
+
 def load_json(file_path):
     try:
         with open(file_path, 'r') as f:
@@ -17,17 +40,8 @@ def load_json(file_path):
         return None
 
 def normalize_smell(smell):
-    smell = smell.lower().replace('_', ' ')
-    if 'data class' in smell:
-        return 'data class'
-    elif 'long method' in smell:
-        return 'long method'
-    elif 'feature envy' in smell:
-        return 'feature envy'
-    elif 'blob' in smell:
-        return 'blob'
-    else:
-        return 'unknown'
+    match = SMELL_PATTERN.search(smell.lower().replace('_', ' '))
+    return match.group(0) if match else 'unknown'
 
 def normalize_severity(severity):
 
@@ -38,20 +52,14 @@ def parse_result(result):
 
     smells = []
     result = result.lower().replace('"', '')
-    lines = result.split('\n')
-    
-    for line in lines:
-        smell = severity = None
-        if 'smell:' in line and 'severity:' in line:
-            parts = line.split(',')
-            for part in parts:
-                if 'smell:' in part:
-                    smell = normalize_smell(part.split(':')[1].strip())
-                elif 'severity:' in part:
-                    severity = normalize_severity(part.split(':')[1].strip())
-            if smell and severity:
-                smells.append((smell, severity))
-    
+
+    for match in VERDICT_PATTERN.finditer(result):
+        smell, severity = (match.group(1), match.group(2)) if match.group(1) is not None else (match.group(4), match.group(3))
+        smell = normalize_smell(smell.split(':')[0].strip())
+        severity = normalize_severity(severity.split(':')[0])
+        if smell and severity:
+            smells.append((smell, severity))
+
     return smells
 
 def compare_results(model_output, ground_truth):
@@ -68,10 +76,31 @@ def compare_results(model_output, ground_truth):
 
     return any(smell == true_smell and severity == true_severity for smell, severity in model_smells)
 
+def encode_prediction(model_output):
+    """Map a model output to (class, severity) codes.
+
+    The predicted class is the first smell reported with a severity other than
+    none, or "no smell". The severity is INVALID when the output has no verdict.
+    """
+    model_smells = parse_result(model_output)
+    if not model_smells:
+        return NO_SMELL, INVALID
+    for smell, severity in model_smells:
+        if severity != 'none' and smell in SMELLS:
+            return LABELS.index(smell), SEVERITIES.index(severity) if severity in SEVERITIES else INVALID
+    return NO_SMELL, SEVERITIES.index('none')
+
+def encode_truth(smell, severity):
+    severity = normalize_severity(severity)
+    severity_code = SEVERITIES.index(severity) if severity in SEVERITIES else INVALID
+    if severity == 'none':
+        return NO_SMELL, severity_code
+    smell = normalize_smell(smell)
+    return (LABELS.index(smell) if smell in SMELLS else NO_SMELL), severity_code
+
 def compute_metrics(results, ground_truth):
     y_true = []
     y_pred = []
-    smells = ['data class', 'long method', 'feature envy', 'blob']
 
     for result in results:
         unique_id = result['unique_id']
@@ -79,49 +108,236 @@ def compute_metrics(results, ground_truth):
             logging.warning(f"Unique ID {unique_id} not found in ground truth data")
             continue
 
-        model_output = result['smell_and_severity']
         truth = ground_truth[unique_id]
-        
-        true_smell = normalize_smell(truth['smell'])
-        true_severity = normalize_severity(truth['severity'])
-        
-        y_true.append(true_smell if true_severity != 'none' else 'none')
-        
-        model_smells = parse_result(model_output)
-        predicted_smell = 'none'
-        for smell, severity in model_smells:
-            if severity != 'none' and smell in smells:
-                predicted_smell = smell
-                break
-        
-        y_pred.append(predicted_smell)
+        y_true.append(LABELS[encode_truth(truth['smell'], truth['severity'])[0]])
+        y_pred.append(LABELS[encode_prediction(result['smell_and_severity'])[0]])
 
     return y_true, y_pred
 
-def main():
-    results_filepath = 'gpt4_results.json'
-    origin_filepath = 'MLCQCodeSmellSamples.json'
-    results = load_json(results_filepath)
-    ground_truth_data = load_json(origin_filepath)
+class GroundTruth:
+    """Ground-truth labels as NumPy arrays, indexed by `unique_id` through `rows`."""
 
-    if results is None or ground_truth_data is None:
-        logging.error("Failed to load necessary data. Exiting.")
-        return
+    def __init__(self, records):
+        self.rows = {}
+        classes, severities = [], []
+        for record in records:
+            self.rows[record['unique_id']] = len(classes)
+            smell_class, severity = encode_truth(record['smell'], record['severity'])
+            classes.append(smell_class)
+            severities.append(severity)
+        self.classes = np.array(classes, dtype=np.int8)
+        self.severities = np.array(severities, dtype=np.int8)
+
+    @classmethod
+    def from_columns(cls, store):
+        """Labels of a columnar store, encoded once per category pair; the store's id index serves as `rows`."""
+        ground_truth = cls([])
+        smells, severities = store.categories['smell'], store.categories['severity']
+        table = np.array([[encode_truth(smell or '', severity or '') for severity in severities] for smell in smells],
+                         dtype=np.int8).reshape(len(smells), len(severities), 2)
+        codes = table[np.asarray(store.columns['smell']), np.asarray(store.columns['severity'])]
+        ground_truth.rows = store
+        ground_truth.classes = codes[:, 0]
+        ground_truth.severities = codes[:, 1]
+        return ground_truth
 
-    logging.info(f"Loaded {len(results)} results and {len(ground_truth_data)} ground truth items")
+    @classmethod
+    def load(cls, file_path):
+        if is_columnar(file_path):
+            return cls.from_columns(ColumnarDataset(file_path))
+        # Only the labels are kept, the snippets are streamed past.
+        return cls({'unique_id': record['unique_id'], 'smell': record['smell'], 'severity': record['severity']}
+                   for record in iter_records(file_path))
 
-    ground_truth = {item['unique_id']: {'smell': item['smell'], 'severity': item['severity']} for item in ground_truth_data}
+    def __len__(self):
+        return len(self.classes)
 
-    y_true, y_pred = compute_metrics(results, ground_truth)
-    
-    smells = ['data class', 'long method', 'feature envy', 'blob']
-    precision, recall, f1, _ = precision_recall_fscore_support(y_true, y_pred, labels=smells, average=None)
+def agreement(votes):
+    """Share of the samples that voted for the most voted answer."""
+    return max(votes.values()) / sum(votes.values()) if votes else float('nan')
 
-    for i, smell in enumerate(smells):
+def encode_results(results, ground_truth):
+    """Turn model outputs into arrays of ground-truth rows, predicted codes and
+    vote agreement (NaN for results without a vote distribution)."""
+    rows, classes, severities, agreements = [], [], [], []
+    missing = 0
+    with span("parse", results=len(results)):
+        for result in results:
+            row = ground_truth.rows.get(result['unique_id'])
+            if row is None:
+                missing += 1
+                continue
+            smell_class, severity = encode_prediction(result['smell_and_severity'])
+            rows.append(row)
+            classes.append(smell_class)
+            severities.append(severity)
+            agreements.append(agreement(result.get('votes')))
+    if missing:
+        logging.warning(f"{missing} unique IDs not found in ground truth data")
+    return (np.array(rows, dtype=np.int64), np.array(classes, dtype=np.int8),
+            np.array(severities, dtype=np.int8), np.array(agreements, dtype=np.float64))
+
+def confusion_matrix(y_true, y_pred, n_labels=len(LABELS)):
+    counts = np.bincount(y_true.astype(np.int64) * n_labels + y_pred, minlength=n_labels * n_labels)
+    return counts.reshape(n_labels, n_labels)
+
+def precision_recall_f1(confusion):
+    """Per-class precision, recall and F1 from confusion matrices of shape (..., L, L),
+    rows being true classes. Undefined ratios are 0, as in scikit-learn."""
+    tp = np.diagonal(confusion, axis1=-2, axis2=-1).astype(np.float64)
+    predicted = confusion.sum(axis=-2)
+    actual = confusion.sum(axis=-1)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        precision = np.where(predicted > 0, tp / predicted, 0.0)
+        recall = np.where(actual > 0, tp / actual, 0.0)
+        f1 = np.where(precision + recall > 0, 2 * precision * recall / (precision + recall), 0.0)
+    return precision, recall, f1
+
+def bootstrap_intervals(confusion, n_bootstrap=1000, confidence=0.95, seed=0):
+    """Percentile confidence intervals of per-class precision, recall and F1.
+
+    Resampling items with replacement is the same as drawing the confusion matrix
+    cells from a multinomial, so all bootstrap replicates are drawn at once
+    without touching the individual items.
+    """
+    n = confusion.sum()
+    if n == 0:
+        return None
+    rng = np.random.default_rng(seed)
+    samples = rng.multinomial(n, confusion.ravel() / n, size=n_bootstrap).reshape(n_bootstrap, *confusion.shape)
+    alpha = (1 - confidence) / 2
+    return {name: np.quantile(values, [alpha, 1 - alpha], axis=0)
+            for name, values in zip(('precision', 'recall', 'f1'), precision_recall_f1(samples))}
+
+def report_from_counts(confusion, invalid, severity_correct, exact_correct, n_bootstrap=1000):
+    precision, recall, f1 = precision_recall_f1(confusion)
+    smells = slice(1, None)
+    count = int(confusion.sum())
+
+    return {
+        'count': count,
+        'invalid': int(invalid),
+        'confusion_matrix': confusion,
+        'precision': precision[smells],
+        'recall': recall[smells],
+        'f1': f1[smells],
+        'macro_f1': float(f1[smells].mean()),
+        'severity_accuracy': severity_correct / count if count else 0.0,
+        'exact_accuracy': exact_correct / count if count else 0.0,
+        'intervals': {name: bounds[:, smells] for name, bounds in
+                      (bootstrap_intervals(confusion, n_bootstrap) or {}).items()} if n_bootstrap else {},
+    }
+
+def agreement_report(agreements, correct):
+    """Accuracy of self-consistency answers by how many of their samples agreed."""
+    voted = ~np.isnan(agreements)
+    bins = np.digitize(agreements[voted], AGREEMENT_EDGES)
+    count = np.bincount(bins, minlength=len(AGREEMENT_LABELS))
+    hits = np.bincount(bins, weights=correct[voted], minlength=len(AGREEMENT_LABELS))
+    with np.errstate(divide='ignore', invalid='ignore'):
+        accuracy = np.where(count > 0, hits / count, 0.0)
+    return float(agreements[voted].mean()), {'count': count, 'exact_accuracy': accuracy}
+
+def evaluate(results, ground_truth, n_bootstrap=1000):
+    rows, pred_classes, pred_severities, agreements = encode_results(results, ground_truth)
+    true_classes = ground_truth.classes[rows]
+    true_severities = ground_truth.severities[rows]
+
+    severity_correct = pred_severities == true_severities
+    exact_correct = severity_correct & (pred_classes == true_classes)
+    report = report_from_counts(confusion_matrix(true_classes, pred_classes),
+                                np.count_nonzero(pred_severities == INVALID),
+                                int(np.count_nonzero(severity_correct)),
+                                int(np.count_nonzero(exact_correct)),
+                                n_bootstrap)
+    if not np.isnan(agreements).all():
+        report['mean_agreement'], report['agreement'] = agreement_report(agreements, exact_correct)
+    return report
+
+class RunningMetrics:
+    """The counts behind `evaluate`, updated one answer at a time while a run streams in."""
+
+    def __init__(self):
+        self.confusion = np.zeros((len(LABELS), len(LABELS)), dtype=np.int64)
+        self.invalid = 0
+        self.severity_correct = 0
+        self.exact_correct = 0
+
+    def update(self, smell, severity, model_output):
+        true_class, true_severity = encode_truth(smell, severity)
+        pred_class, pred_severity = encode_prediction(model_output)
+        self.confusion[true_class, pred_class] += 1
+        self.invalid += pred_severity == INVALID
+        self.severity_correct += pred_severity == true_severity
+        self.exact_correct += pred_severity == true_severity and pred_class == true_class
+
+    def report(self, n_bootstrap=0):
+        return report_from_counts(self.confusion.copy(), self.invalid, self.severity_correct, self.exact_correct,
+                                  n_bootstrap)
+
+def evaluate_runs(ground_truth_filepath, results_filepaths, n_bootstrap=1000):
+    """Score several result files (models or runs) against one load of the ground truth."""
+    ground_truth = GroundTruth.load(ground_truth_filepath)
+    logging.info(f"Loaded {len(ground_truth)} ground truth items")
+
+    reports = {}
+    for results_filepath in results_filepaths:
+        try:
+            results = list(iter_records(results_filepath))
+        except (FileNotFoundError, ValueError, json.JSONDecodeError) as e:
+            logging.error(f"Could not read {results_filepath}: {e}")
+            continue
+        logging.info(f"Loaded {len(results)} results from {results_filepath}")
+        reports[results_filepath] = evaluate(results, ground_truth, n_bootstrap)
+    return reports
+
+def log_report(name, report):
+    logging.info(f"Results for {name} ({report['count']} items, {report['invalid']} without a valid answer):")
+    for i, smell in enumerate(SMELLS):
         logging.info(f"Metrics for {smell}:")
-        logging.info(f"  Precision: {precision[i]:.4f}")
-        logging.info(f"  Recall: {recall[i]:.4f}")
-        logging.info(f"  F1 Score: {f1[i]:.4f}")
+        for metric, label in (('precision', 'Precision'), ('recall', 'Recall'), ('f1', 'F1 Score')):
+            line = f"  {label}: {report[metric][i]:.4f}"
+            if metric in report['intervals']:
+                low, high = report['intervals'][metric][:, i]
+                line += f" [{low:.4f}, {high:.4f}]"
+            logging.info(line)
+    logging.info(f"  Macro F1: {report['macro_f1']:.4f}")
+    logging.info(f"  Severity accuracy: {report['severity_accuracy']:.4f}")
+    logging.info(f"  Smell and severity accuracy: {report['exact_accuracy']:.4f}")
+    if 'agreement' in report:
+        logging.info(f"  Mean vote agreement: {report['mean_agreement']:.4f}")
+        for label, count, accuracy in zip(AGREEMENT_LABELS, report['agreement']['count'],
+                                          report['agreement']['exact_accuracy']):
+            logging.info(f"    {label:>9} agreement: {int(count)} items, smell and severity accuracy {accuracy:.4f}")
+
+def report_to_json(report):
+    return {key: (value.tolist() if isinstance(value, np.ndarray) else
+                  {k: v.tolist() for k, v in value.items()} if isinstance(value, dict) else value)
+            for key, value in report.items()}
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('results', nargs='*', default=['gpt4_results.json'],
+                        help="Result files to evaluate, e.g. one per model or run")
+    parser.add_argument('--ground-truth', default='MLCQCodeSmellSamples.json')
+    parser.add_argument('--bootstrap', type=int, default=1000,
+                        help="Bootstrap replicates for the 95%% confidence intervals (0 to disable)")
+    parser.add_argument('--summary', default=None, help="Also write all metrics to this JSON file")
+    add_telemetry_arguments(parser)
+    args = parser.parse_args()
+    configure(args.trace, args.metrics_port)
+
+    reports = evaluate_runs(args.ground_truth, args.results, args.bootstrap)
+    if not reports:
+        logging.error("Failed to load necessary data. Exiting.")
+        return
+
+    for name, report in reports.items():
+        log_report(name, report)
+
+    if args.summary:
+        with open(args.summary, 'w') as f:
+            json.dump({name: report_to_json(report) for name, report in reports.items()}, f, indent=4)
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,81 @@
+import re
+
+import torch
+import transformers
+
+SMELL_NAMES = ["feature_envy", "long_method", "blob", "data_class"]
+SEVERITY_NAMES = ["none", "minor", "moderate", "severe"]
+
+# Every answer the prompt allows, in the exact requested format.
+CANDIDATE_ANSWERS = [f"Smell: {smell}, Severity: {severity}" for smell in SMELL_NAMES for severity in SEVERITY_NAMES]
+
+ANSWER_PATTERN = re.compile(
+    r"smell:\s*\"?(" + "|".join(SMELL_NAMES) + r")\"?\s*,\s*severity:\s*\"?(" + "|".join(SEVERITY_NAMES) + r")\b",
+    re.IGNORECASE,
+)
+
+# Same label grammar for llama.cpp, which masks every token that would leave it.
+GBNF_GRAMMAR = "\n".join([
+    'root ::= "Smell: " smell ", Severity: " severity',
+    "smell ::= " + " | ".join(f'"{smell}"' for smell in SMELL_NAMES),
+    "severity ::= " + " | ".join(f'"{severity}"' for severity in SEVERITY_NAMES),
+])
+
+# Longest candidate in tokens for any reasonable tokenizer, used to cap grammar-constrained generation.
+MAX_ANSWER_TOKENS = 24
+
+
+class AnswerStoppingCriteria(transformers.StoppingCriteria):
+    """Stops each sequence as soon as its generated text holds a complete, valid answer."""
+
+    def __init__(self, tokenizer):
+        self.tokenizer = tokenizer
+        self.prompt_length = None
+
+    def __call__(self, input_ids, scores, **kwargs):
+        # Called after every new token, so the first call tells where the prompt ends.
+        if self.prompt_length is None:
+            self.prompt_length = input_ids.shape[1] - 1
+        texts = self.tokenizer.batch_decode(input_ids[:, self.prompt_length:], skip_special_tokens=True)
+        return torch.tensor([ANSWER_PATTERN.search(text) is not None for text in texts],
+                            dtype=torch.bool, device=input_ids.device)
+
+
+def stopping_criteria(tokenizer):
+    return transformers.StoppingCriteriaList([AnswerStoppingCriteria(tokenizer)])
+
+
+def candidate_token_ids(tokenizer, candidates=CANDIDATE_ANSWERS):
+    """Right-padded token ids of the candidates and the mask of their real tokens."""
+    encoded = [tokenizer(candidate, add_special_tokens=False)["input_ids"] for candidate in candidates]
+    length = max(len(ids) for ids in encoded)
+    pad_id = tokenizer.pad_token_id if tokenizer.pad_token_id is not None else 0
+    ids = torch.tensor([row + [pad_id] * (length - len(row)) for row in encoded])
+    mask = torch.tensor([[1] * len(row) + [0] * (length - len(row)) for row in encoded], dtype=torch.bool)
+    return ids, mask
+
+
+@torch.no_grad()
+def score_candidates(model, prompt_ids, candidate_ids, candidate_mask, cache=None):
+    """Log-likelihood of every candidate answer following the prompt.
+
+    The prompt is prefilled once (on top of `cache`, e.g. a copy of a prefix
+    cache), its cache is repeated for the candidates and all of them are scored
+    in a single forward pass. Candidates are right padded, which causal attention
+    never lets leak into the real tokens' scores.
+    """
+    cache = cache if cache is not None else transformers.DynamicCache()
+    output = model(prompt_ids.to(model.device), past_key_values=cache, use_cache=True)
+    first_logits = output.logits[:, -1:, :]
+
+    count = candidate_ids.shape[0]
+    cache.batch_repeat_interleave(count)
+    candidate_ids = candidate_ids.to(model.device)
+    logits = model(candidate_ids, past_key_values=cache, use_cache=True).logits
+
+    # Token j of a candidate is predicted by the logits at position j - 1, the
+    # first one by the prompt's last position.
+    predicting = torch.cat([first_logits.expand(count, -1, -1), logits[:, :-1, :]], dim=1)
+    log_probs = torch.log_softmax(predicting.float(), dim=-1)
+    token_log_probs = log_probs.gather(-1, candidate_ids.unsqueeze(-1)).squeeze(-1)
+    return (token_log_probs * candidate_mask.to(model.device)).sum(dim=-1)
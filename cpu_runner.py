@@ -0,0 +1,228 @@
+import argparse
+import logging
+import multiprocessing
+import os
+import queue
+import threading
+
+import tqdm
+
+from dataset import iter_records, add_dataset_arguments, shard_path
+from storage import JsonlWriter, jsonl_path_for, load_existing_results, export_results
+
+logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(message)s")
+
+THREAD_ENV_VARS = ("OMP_NUM_THREADS", "MKL_NUM_THREADS", "OPENBLAS_NUM_THREADS")
+# Sampling temperature of the llama.cpp backend, the same as llama.py's.
+TEMPERATURE = 0.7
+
+
+def pin_threads(index, threads):
+    """Restrict this process to `threads` threads on its own block of cores.
+
+    Must run before torch / llama.cpp are imported, which size their thread
+    pools from these variables.
+    """
+    for name in THREAD_ENV_VARS:
+        os.environ[name] = str(threads)
+    if hasattr(os, "sched_setaffinity"):
+        cores = sorted(os.sched_getaffinity(0))
+        block = cores[index * threads:(index + 1) * threads]
+        if len(block) == threads:
+            os.sched_setaffinity(0, block)
+
+
+class TransformersBackend:
+    """Runs snippets through llama.py's batched transformers pipeline."""
+
+    def __init__(self, config):
+        import torch
+        import llama
+        torch.set_num_threads(config["threads"])
+        llama.load_pipeline(config["model"])
+        self.llama = llama
+        self.config = config
+
+    def classify(self, snippets):
+        return self.llama.detect_smell_and_severity_batch(snippets, batch_size=self.config["batch_size"],
+                                                          use_cache=self.config["use_cache"],
+                                                          constrained=self.config["constrained"])
+
+
+class LlamaCppBackend:
+    """Runs snippets through a (quantized) GGUF model with llama.cpp."""
+
+    def __init__(self, config):
+        from llama_cpp import Llama, LlamaGrammar
+        from constrained import GBNF_GRAMMAR, MAX_ANSWER_TOKENS
+        from prompts import llama_prompt
+        from response_cache import ResponseCache
+        from token_budget import TokenBudgeter
+
+        self.llm = Llama(model_path=config["model"], n_ctx=config["context_window"],
+                         n_threads=config["threads"], verbose=False)
+        self.llama_prompt = llama_prompt
+        self.model_name = os.path.basename(config["model"])
+        self.max_new_tokens = config["max_new_tokens"]
+        self.grammar = None
+        self.params = {}
+        if config["constrained"]:
+            # Sampling is restricted to the label grammar, which also ends generation.
+            self.grammar = LlamaGrammar.from_string(GBNF_GRAMMAR, verbose=False)
+            self.max_new_tokens = MAX_ANSWER_TOKENS
+            self.params = {"constrained": True}
+        self.cache = ResponseCache() if config["use_cache"] else None
+        self.budgeter = TokenBudgeter(lambda text: self.llm.tokenize(text.encode("utf-8"), add_bos=False),
+                                      lambda ids: self.llm.detokenize(ids).decode("utf-8", errors="ignore"),
+                                      config["context_window"])
+        self.snippet_tokens = self.budgeter.snippet_budget(self.llama_prompt(""), reserved=self.max_new_tokens + 1)
+
+    def classify(self, snippets):
+        outputs = []
+        for snippet in snippets:
+            prompt = self.llama_prompt(self.budgeter.truncate(snippet, self.snippet_tokens))
+            output = (self.cache.get(self.model_name, prompt, TEMPERATURE, self.max_new_tokens, **self.params)
+                      if self.cache else None)
+            if output is None:
+                completion = self.llm(prompt, max_tokens=self.max_new_tokens, temperature=TEMPERATURE,
+                                      grammar=self.grammar)
+                output = completion["choices"][0]["text"].strip()
+                if self.cache:
+                    self.cache.set(self.model_name, prompt, TEMPERATURE, self.max_new_tokens, output, **self.params)
+            outputs.append(output)
+        return outputs
+
+
+BACKENDS = {"transformers": TransformersBackend, "llama_cpp": LlamaCppBackend}
+
+
+def worker(index, config, tasks, results):
+    pin_threads(index, config["threads"])
+    backend = BACKENDS[config["backend"]](config)
+    results.put(("ready", index))
+
+    while True:
+        task = tasks.get()
+        if task is None:
+            break
+        unique_ids = [unique_id for unique_id, _ in task]
+        try:
+            outputs = backend.classify([snippet for _, snippet in task])
+        except Exception:
+            logging.exception(f"Worker {index} failed on snippets {unique_ids}")
+            outputs = [None] * len(task)
+        results.put(("done", list(zip(unique_ids, outputs))))
+
+
+def feed(records, processed_ids, tasks, task_size, workers, counter):
+    task = []
+    for entry in records:
+        if entry['unique_id'] in processed_ids:
+            continue
+        task.append((entry['unique_id'], entry['code_snippet']))
+        if len(task) == task_size:
+            tasks.put(task)
+            counter["tasks"] += 1
+            task = []
+    if task:
+        tasks.put(task)
+        counter["tasks"] += 1
+    for _ in range(workers):
+        tasks.put(None)
+    counter["fed"] = True
+
+
+def run(file_path, results_filepath, workers=None, threads_per_worker=None, backend="transformers", model=None,
+        task_size=None, batch_size=4, context_window=8192, max_new_tokens=150, save_every=20, use_cache=True,
+        constrained=False, shard=None, smells=None, severities=None):
+    """Classify the dataset with a pool of worker processes, each holding its own model.
+
+    Workers pull small lists of snippets from a shared queue, so faster workers
+    simply take more work. Results are appended as they arrive and merged by
+    unique_id into `results_filepath` at the end.
+    """
+    cores = len(os.sched_getaffinity(0)) if hasattr(os, "sched_getaffinity") else os.cpu_count()
+    threads_per_worker = threads_per_worker or max(1, cores // (workers or 4))
+    workers = workers or max(1, cores // threads_per_worker)
+    task_size = task_size or (batch_size if backend == "transformers" else 1)
+
+    config = {
+        "backend": backend,
+        "model": model,
+        "threads": threads_per_worker,
+        "batch_size": batch_size,
+        "context_window": context_window,
+        "max_new_tokens": max_new_tokens,
+        "use_cache": use_cache,
+        "constrained": constrained,
+    }
+    logging.info(f"Starting {workers} workers with {threads_per_worker} threads each ({backend})")
+
+    processed_ids = {result['unique_id'] for result in load_existing_results(results_filepath)}
+    records = iter_records(file_path, shard=shard, smells=smells, severities=severities)
+
+    context = multiprocessing.get_context("spawn")
+    tasks = context.Queue(maxsize=workers * 2)
+    results = context.Queue()
+    processes = [context.Process(target=worker, args=(i, config, tasks, results), daemon=True)
+                 for i in range(workers)]
+    for process in processes:
+        process.start()
+
+    counter = {"tasks": 0, "fed": False}
+    feeder = threading.Thread(target=feed, args=(records, processed_ids, tasks, task_size, workers, counter),
+                              daemon=True)
+    feeder.start()
+
+    done = 0
+    pending = []
+    with JsonlWriter(jsonl_path_for(results_filepath)) as writer, tqdm.tqdm(desc="Processing snippets") as pbar:
+        while not (counter["fed"] and done == counter["tasks"]):
+            try:
+                kind, payload = results.get(timeout=1)
+            except queue.Empty:
+                if not any(process.is_alive() for process in processes):
+                    logging.error("All workers exited before the work was done")
+                    break
+                continue
+            if kind == "ready":
+                continue
+
+            done += 1
+            for unique_id, output in payload:
+                if output is not None:
+                    pending.append({'unique_id': unique_id, 'smell_and_severity': output})
+            pbar.update(len(payload))
+            if len(pending) >= save_every:
+                writer.write_batch(pending)
+                pending = []
+        writer.write_batch(pending)
+
+    for process in processes:
+        process.join(timeout=10)
+    export_results(results_filepath)
+    print(f"Smell detection completed. Results saved to {results_filepath}")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Multi-process CPU inference for the local model")
+    add_dataset_arguments(parser)
+    parser.add_argument("--output", default='llama_cpu_results.json', help="Results file")
+    parser.add_argument("--backend", choices=sorted(BACKENDS), default="transformers")
+    parser.add_argument("--model", default=None,
+                        help="Hugging Face model id for transformers, path to a GGUF file for llama_cpp")
+    parser.add_argument("--workers", type=int, default=None, help="Worker processes (default: cores / threads)")
+    parser.add_argument("--threads-per-worker", type=int, default=None, help="Threads pinned to each worker")
+    parser.add_argument("--batch-size", type=int, default=4, help="Snippets per generation batch (transformers)")
+    parser.add_argument("--context-window", type=int, default=8192, help="Context size (llama_cpp)")
+    parser.add_argument("--no-cache", action="store_true", help="Do not read or write the response cache")
+    parser.add_argument("--constrained", action="store_true",
+                        help="Restrict answers to the 16 valid labels (candidate scoring or a llama.cpp grammar)")
+    args = parser.parse_args()
+    if args.backend == "llama_cpp" and not args.model:
+        parser.error("--model must point at a GGUF file with --backend llama_cpp")
+
+    run(args.input, shard_path(args.output, args.shard), workers=args.workers,
+        threads_per_worker=args.threads_per_worker, backend=args.backend, model=args.model,
+        batch_size=args.batch_size, context_window=args.context_window, use_cache=not args.no_cache,
+        constrained=args.constrained, shard=args.shard, smells=args.smells, severities=args.severities)
@@ -0,0 +1,132 @@
+import json
+import os
+import zlib
+
+CHUNK_SIZE = 1 << 16
+
+
+def parse_shard(spec):
+    """Parse a "--shard i/N" spec into (i, N)."""
+    if spec is None:
+        return None
+    index, count = (int(part) for part in spec.split("/"))
+    if count < 1 or not 0 <= index < count:
+        raise ValueError(f"Invalid shard {spec!r}, expected i/N with 0 <= i < N")
+    return index, count
+
+
+def shard_path(path, shard):
+    """Give each shard its own output file, e.g. results.json -> results.shard0of4.json."""
+    if shard is None:
+        return path
+    root, ext = os.path.splitext(path)
+    return f"{root}.shard{shard[0]}of{shard[1]}{ext}"
+
+
+def normalize_label(label):
+    return label.lower().replace("_", " ").strip()
+
+
+def in_shard(unique_id, shard):
+    # Hash the id rather than use the record position so that a shard holds the
+    # same records whether it is read from the JSONL log or the exported array.
+    index, count = shard
+    return zlib.crc32(str(unique_id).encode("utf-8")) % count == index
+
+
+def _iter_jsonl(f):
+    for line in f:
+        line = line.strip()
+        if line:
+            yield json.loads(line)
+
+
+def _iter_json_array(f):
+    """Incrementally decode the elements of a top-level JSON array."""
+    decoder = json.JSONDecoder()
+    buffer = f.read(CHUNK_SIZE)
+    pos = 0
+    eof = not buffer
+
+    def skip(chars):
+        nonlocal buffer, pos, eof
+        while True:
+            while pos < len(buffer) and buffer[pos] in chars:
+                pos += 1
+            if pos < len(buffer) or eof:
+                return
+            buffer, pos = f.read(CHUNK_SIZE), 0
+            eof = not buffer
+
+    skip(" \t\r\n")
+    if eof or buffer[pos] != "[":
+        raise ValueError("Expected a JSON array")
+    pos += 1
+
+    while True:
+        skip(" \t\r\n,")
+        if eof:
+            raise ValueError("Unterminated JSON array")
+        if buffer[pos] == "]":
+            return
+        try:
+            record, end = decoder.raw_decode(buffer, pos)
+        except json.JSONDecodeError:
+            record, end = None, None
+        if end is None or (end == len(buffer) and not eof):
+            # The element straddles the chunk boundary, read more and retry.
+            more = f.read(CHUNK_SIZE)
+            if not more:
+                if end is None:
+                    raise ValueError("Truncated JSON array")
+                eof = True
+            buffer, pos = buffer[pos:] + more, 0
+            continue
+        yield record
+        pos = end
+
+
+def iter_records(file_path, shard=None, smells=None, severities=None):
+    """Lazily yield dataset records from a JSONL file, a JSON array file or a columnar store.
+
+    `shard` is an (index, count) pair as returned by `parse_shard`. `smells` and
+    `severities` restrict the records to the given labels ("long_method" and
+    "long method" are treated alike).
+    """
+    from columnar import is_columnar, ColumnarDataset
+    if is_columnar(file_path):
+        yield from ColumnarDataset(file_path).iter_records(shard, smells, severities)
+        return
+
+    smells = {normalize_label(smell) for smell in smells} if smells else None
+    severities = {normalize_label(severity) for severity in severities} if severities else None
+
+    with open(file_path, "r", encoding="utf-8") as f:
+        first = f.read(1)
+        while first and first.isspace():
+            first = f.read(1)
+        f.seek(0)
+        records = _iter_json_array(f) if first == "[" else _iter_jsonl(f)
+
+        for record in records:
+            # DataExtractor names the identifier "id", the published dataset "unique_id".
+            if "unique_id" not in record and "id" in record:
+                record["unique_id"] = record["id"]
+            if shard is not None and not in_shard(record["unique_id"], shard):
+                continue
+            if smells is not None and normalize_label(record["smell"]) not in smells:
+                continue
+            if severities is not None and normalize_label(record["severity"]) not in severities:
+                continue
+            yield record
+
+
+def add_dataset_arguments(parser, default_input="MLCQCodeSmellSamples.json"):
+    parser.add_argument("--input", default=default_input,
+                        help="Dataset to read, as a JSON array, a JSONL file or a columnar store (columnar.py)")
+    parser.add_argument("--shard", type=parse_shard, default=None,
+                        help="Only process shard i of N, e.g. --shard 0/4")
+    parser.add_argument("--smell", action="append", dest="smells",
+                        help="Only process samples with this smell (repeatable)")
+    parser.add_argument("--severity", action="append", dest="severities",
+                        help="Only process samples with this severity (repeatable)")
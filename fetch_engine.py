@@ -0,0 +1,161 @@
+import logging
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from telemetry import count
+
+RAW_BASE_URL = "https://raw.githubusercontent.com"
+
+# GitHub allows 5000 authenticated requests per hour, keep some headroom.
+DEFAULT_REQUESTS_PER_HOUR = 4500
+
+
+class TokenBucket:
+    """Thread-safe token bucket, refilled continuously at `rate` tokens per second."""
+
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.last_refill = time.monotonic()
+        self.paused_until = 0.0
+        self.lock = threading.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.last_refill) * self.rate)
+        self.last_refill = now
+
+    def acquire(self, tokens=1):
+        while True:
+            with self.lock:
+                self._refill()
+                wait = self.paused_until - time.monotonic()
+                if wait <= 0 and self.tokens >= tokens:
+                    self.tokens -= tokens
+                    return
+                if wait <= 0:
+                    wait = (tokens - self.tokens) / self.rate
+            time.sleep(wait)
+
+    def pause_until(self, wall_clock_ts):
+        """Block every caller until the given unix timestamp."""
+        with self.lock:
+            self.paused_until = max(self.paused_until, time.monotonic() + max(0.0, wall_clock_ts - time.time()))
+
+    def update_from_headers(self, headers):
+        """Adapt to GitHub's X-RateLimit-* headers when the server sends them."""
+        remaining = headers.get("X-RateLimit-Remaining")
+        reset = headers.get("X-RateLimit-Reset")
+        if remaining is None or reset is None:
+            return
+        try:
+            remaining = int(remaining)
+            reset = float(reset)
+        except ValueError:
+            return
+
+        if remaining <= 0:
+            logging.warning(f"Rate limit exhausted, pausing until {time.ctime(reset)}")
+            self.pause_until(reset)
+            return
+
+        # Spread what is left of the quota evenly over the rest of the window.
+        window = max(1.0, reset - time.time())
+        with self.lock:
+            self._refill()
+            self.tokens = min(self.tokens, remaining)
+            self.rate = remaining / window
+
+
+def default_rate_limiter(requests_per_hour=DEFAULT_REQUESTS_PER_HOUR):
+    return TokenBucket(rate=requests_per_hour / 3600, capacity=requests_per_hour)
+
+
+def ordered_map(fn, jobs, concurrency):
+    """Apply `fn` to every job on `concurrency` threads, yielding results in input order.
+
+    At most `concurrency * 4` jobs are in flight so that huge inputs are not
+    materialised up front.
+    """
+    window = concurrency * 4
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        pending = deque()
+        for job in jobs:
+            pending.append(executor.submit(fn, job))
+            if len(pending) >= window:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+
+
+class RawFileFetcher:
+    """Fetches raw files over a pooled HTTP session shared by a bounded set of worker threads."""
+
+    def __init__(self, token=None, concurrency=8, rate_limiter=None, base_url=RAW_BASE_URL,
+                 timeout=30, retries=3):
+        self.concurrency = concurrency
+        self.rate_limiter = rate_limiter or default_rate_limiter()
+        self.base_url = base_url.rstrip("/")
+        self.timeout = timeout
+        self.retries = retries
+
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=concurrency, pool_maxsize=concurrency)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+        if token:
+            self.session.headers["Authorization"] = f"token {token}"
+
+    def raw_url(self, repo_name, commit_hash, file_path):
+        return f"{self.base_url}/{repo_name}/{commit_hash}/{file_path.lstrip('/')}"
+
+    def fetch_file(self, repo_name, commit_hash, file_path):
+        """Return the text of one file, or None if it cannot be fetched."""
+        url = self.raw_url(repo_name, commit_hash, file_path)
+        status = None
+
+        for attempt in range(self.retries):
+            if attempt:
+                count("fetch_retries")
+            self.rate_limiter.acquire()
+            try:
+                response = self.session.get(url, timeout=self.timeout)
+            except requests.RequestException as e:
+                logging.warning(f"Request to {url} failed: {e}")
+                time.sleep(2 ** attempt)
+                continue
+
+            self.rate_limiter.update_from_headers(response.headers)
+            status = response.status_code
+
+            if response.status_code == 200:
+                return response.text
+            if response.status_code in (403, 429):
+                count("fetch_rate_limited")
+                retry_after = response.headers.get("Retry-After")
+                if retry_after is not None and retry_after.isdigit():
+                    self.rate_limiter.pause_until(time.time() + int(retry_after))
+                elif response.headers.get("X-RateLimit-Remaining") is None:
+                    # Not a rate-limit response, retrying will not help.
+                    break
+                continue
+            if response.status_code >= 500:
+                time.sleep(2 ** attempt)
+                continue
+            break
+
+        logging.warning(f"Failed to fetch code from {url} (status code: {status})")
+        return None
+
+    def map(self, fn, jobs):
+        """Apply `fn` to every job on the worker threads, yielding results in input order."""
+        return ordered_map(fn, jobs, self.concurrency)
+
+    def close(self):
+        self.session.close()
@@ -0,0 +1,97 @@
+import hashlib
+import logging
+import os
+import tempfile
+import threading
+from collections import OrderedDict
+
+DEFAULT_CACHE_DIR = ".raw_file_cache"
+DEFAULT_MAX_BYTES = 2 * 1024 ** 3
+
+
+def file_key(repo_name, commit_hash, file_path):
+    """A file at a given commit never changes, so this key identifies its content."""
+    raw = f"{repo_name}\0{commit_hash}\0{file_path.lstrip('/')}"
+    return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+
+class FileCache:
+    """On-disk cache of raw files keyed by (repo, commit, path), capped at `max_bytes`.
+
+    Entries are evicted least-recently-used first. Recency survives restarts through
+    the files' modification times, which are bumped on every hit.
+    """
+
+    def __init__(self, directory=DEFAULT_CACHE_DIR, max_bytes=DEFAULT_MAX_BYTES):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()
+        self.total_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        os.makedirs(directory, exist_ok=True)
+        self._load_index()
+
+    def _path(self, key):
+        return os.path.join(self.directory, key[:2], key)
+
+    def _load_index(self):
+        found = []
+        for root, _, files in os.walk(self.directory):
+            for name in files:
+                if name.endswith(".tmp"):
+                    continue
+                stat = os.stat(os.path.join(root, name))
+                found.append((stat.st_mtime, name, stat.st_size))
+        for _, key, size in sorted(found):
+            self.entries[key] = size
+            self.total_bytes += size
+
+    def get(self, repo_name, commit_hash, file_path):
+        key = file_key(repo_name, commit_hash, file_path)
+        with self.lock:
+            if key not in self.entries:
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+        path = self._path(key)
+        try:
+            with open(path, "r", encoding="utf-8") as f:
+                text = f.read()
+            os.utime(path)
+        except FileNotFoundError:
+            with self.lock:
+                self.total_bytes -= self.entries.pop(key, 0)
+            return None
+        return text
+
+    def put(self, repo_name, commit_hash, file_path, text):
+        key = file_key(repo_name, commit_hash, file_path)
+        path = self._path(key)
+        data = text.encode("utf-8")
+        if len(data) > self.max_bytes:
+            return
+
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix=".tmp")
+        with os.fdopen(fd, "wb") as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+
+        with self.lock:
+            self.total_bytes -= self.entries.pop(key, 0)
+            self.entries[key] = len(data)
+            self.total_bytes += len(data)
+            self._evict()
+
+    def _evict(self):
+        while self.total_bytes > self.max_bytes and self.entries:
+            key, size = self.entries.popitem(last=False)
+            self.total_bytes -= size
+            try:
+                os.remove(self._path(key))
+            except FileNotFoundError:
+                pass
+            logging.debug(f"Evicted {key} from file cache")
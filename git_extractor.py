@@ -0,0 +1,139 @@
+"""Reads MLCQ snippets from local git clones or bare mirrors instead of raw.githubusercontent.com.
+
+Blobs are read with one long-lived `git cat-file --batch` process per repository,
+so no commit is ever checked out and there is no token or rate limit. Mirrors
+are looked up under a directory as owner/repo.git, owner/repo, repo.git or repo;
+`python git_extractor.py --mirrors mirrors` clones the ones a CSV needs.
+"""
+import argparse
+import logging
+import os
+import subprocess
+import threading
+
+from fetch_engine import ordered_map
+from telemetry import count
+
+GITHUB_CLONE_URL = "https://github.com/{}.git"
+
+
+def find_repository(mirrors_dir, repo_name):
+    """Path of the local clone or mirror of "owner/repo" under `mirrors_dir`, or None."""
+    owner, _, name = repo_name.partition("/")
+    for candidate in (f"{owner}/{name}.git", f"{owner}/{name}", f"{name}.git", name):
+        path = os.path.join(mirrors_dir, candidate)
+        if os.path.isdir(path):
+            return path
+    return None
+
+
+class GitBlobReader:
+    """A `git cat-file --batch` process answering "<commit>:<path>" lookups for one repository."""
+
+    def __init__(self, repo_path):
+        self.repo_path = repo_path
+        self.lock = threading.Lock()
+        self.process = subprocess.Popen(["git", "-C", repo_path, "cat-file", "--batch"],
+                                        stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+
+    def read(self, commit_hash, file_path):
+        """Text of `file_path` at `commit_hash`, or None if the object does not exist."""
+        with self.lock:
+            self.process.stdin.write(f"{commit_hash}:{file_path.lstrip('/')}\n".encode("utf-8"))
+            self.process.stdin.flush()
+            # "<sha> <type> <size>", or "<spec> missing" / "<spec> ambiguous" where
+            # the spec is "<commit>:<path>" and the path may contain spaces.
+            header = self.process.stdout.readline().split()
+            if not header:
+                raise RuntimeError(f"git cat-file exited in {self.repo_path}")
+            if header[-1] in (b"missing", b"ambiguous"):
+                return None
+            _, kind, size = header
+            data = self.process.stdout.read(int(size))
+            self.process.stdout.read(1)
+        if kind != b"blob":
+            return None
+        return data.decode("utf-8", errors="replace")
+
+    def close(self):
+        self.process.stdin.close()
+        self.process.wait()
+
+
+class GitFetcher:
+    """Drop-in replacement for RawFileFetcher reading files from local repositories.
+
+    Files whose repository or commit is not available locally are fetched from
+    `fallback` (e.g. a RawFileFetcher) when one is given.
+    """
+
+    def __init__(self, mirrors_dir, concurrency=None, fallback=None):
+        self.mirrors_dir = mirrors_dir
+        self.concurrency = concurrency or os.cpu_count()
+        self.fallback = fallback
+        self.readers = {}
+        self.lock = threading.Lock()
+
+    def reader(self, repo_name):
+        with self.lock:
+            if repo_name not in self.readers:
+                path = find_repository(self.mirrors_dir, repo_name)
+                if path is None:
+                    logging.warning(f"No local repository for {repo_name} in {self.mirrors_dir}")
+                self.readers[repo_name] = GitBlobReader(path) if path else None
+            return self.readers[repo_name]
+
+    def fetch_file(self, repo_name, commit_hash, file_path):
+        """Return the text of one file, or None if it is neither local nor available from the fallback."""
+        reader = self.reader(repo_name)
+        text = reader.read(commit_hash, file_path) if reader else None
+        if text is None and self.fallback is not None:
+            count("git_fallbacks")
+            return self.fallback.fetch_file(repo_name, commit_hash, file_path)
+        if text is None:
+            logging.warning(f"{file_path} at {commit_hash} not found in the local copy of {repo_name}")
+        return text
+
+    def map(self, fn, jobs):
+        """Apply `fn` to every job, yielding results in input order.
+
+        Each repository has a single cat-file process, so threads only help across
+        repositories (and for the fallback).
+        """
+        return ordered_map(fn, jobs, self.concurrency)
+
+    def close(self):
+        for reader in self.readers.values():
+            if reader is not None:
+                reader.close()
+        self.readers = {}
+        if self.fallback is not None:
+            self.fallback.close()
+
+
+def mirror_repositories(csv_file, mirrors_dir, clone_url=GITHUB_CLONE_URL):
+    """Create or update a bare mirror of every repository referenced by the CSV."""
+    from DataExtractor import iter_csv_rows, repo_name_from_url
+
+    with open(csv_file, "r") as f:
+        repo_names = sorted({repo_name_from_url(row["repo_url"]) for row in iter_csv_rows(f)})
+    for repo_name in repo_names:
+        path = find_repository(mirrors_dir, repo_name)
+        if path is not None:
+            logging.info(f"Updating {repo_name}")
+            command = ["git", "-C", path, "remote", "update", "--prune"]
+        else:
+            path = os.path.join(mirrors_dir, f"{repo_name}.git")
+            logging.info(f"Mirroring {repo_name} into {path}")
+            command = ["git", "clone", "--mirror", "--quiet", clone_url.format(repo_name), path]
+        if subprocess.run(command).returncode != 0:
+            logging.warning(f"Could not mirror {repo_name}")
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(message)s")
+    parser = argparse.ArgumentParser(description="Mirror every repository referenced by the MLCQ CSV")
+    parser.add_argument("--csv", default="MLCQCodeSmellSamples.csv")
+    parser.add_argument("--mirrors", default="mirrors", help="Directory holding the bare mirrors")
+    args = parser.parse_args()
+    mirror_repositories(args.csv, args.mirrors)
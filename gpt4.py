@@ -1,14 +1,24 @@
-from openai import OpenAI
-from openai import OpenAIError, RateLimitError
+from openai import AsyncOpenAI
+from openai import RateLimitError, APIConnectionError, APITimeoutError, InternalServerError
 import openai
-import json
+import argparse
+import asyncio
 import logging
 import tqdm
 import os 
-import time
+
+from prompts import gpt_system_prompt, few_shot_prompt, format_example
+from retrieval import FewShotIndex, DEFAULT_FEW_SHOT_K, DEFAULT_FEW_SHOT_TOKENS, add_few_shot_arguments
+from response_cache import get_response_cache
+from scheduler import AdaptiveScheduler, aiterate
+from token_budget import TokenBudgeter, aggregate_verdicts
+from storage import JsonlWriter, jsonl_path_for, load_existing_results, export_results, save_results
+from dataset import iter_records, add_dataset_arguments, shard_path
+from telemetry import span, count, configure, add_telemetry_arguments
+from voting import next_round, vote_chunks
 
 openai.api_key = os.getenv("OPENAI_API_KEY")
-client = OpenAI()
+async_client = None
 
 
 logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(message)s",
@@ -17,116 +27,274 @@ logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(message)s",
                         logging.StreamHandler()
                     ])
 
-MAX_CHARS = 20000
-
-
-# --------------------------------- Few shot prompts ----------------------------------#
-examples = [
-{
-        "code_snippet": "  @Override\n  public boolean incrementToken() throws IOException {\n    for(;;) {\n\n      if (!remainingTokens.isEmpty()) {\n        // clearAttributes();  // not currently necessary\n        restoreState(remainingTokens.removeFirst());\n        return true;\n      }\n\n      if (!input.incrementToken()) return false;\n\n      int len = termAtt.length();\n      if (len==0) return true; // pass through zero length terms\n      \n      int firstAlternativeIncrement = inject ? 0 : posAtt.getPositionIncrement();\n\n      String v = termAtt.toString();\n      String primaryPhoneticValue = encoder.doubleMetaphone(v);\n      String alternatePhoneticValue = encoder.doubleMetaphone(v, true);\n\n      // a flag to lazily save state if needed... this avoids a save/restore when only\n      // one token will be generated.\n      boolean saveState=inject;\n\n      if (primaryPhoneticValue!=null && primaryPhoneticValue.length() > 0 && !primaryPhoneticValue.equals(v)) {\n        if (saveState) {\n          remainingTokens.addLast(captureState());\n        }\n        posAtt.setPositionIncrement( firstAlternativeIncrement );\n        firstAlternativeIncrement = 0;\n        termAtt.setEmpty().append(primaryPhoneticValue);\n        saveState = true;\n      }\n\n      if (alternatePhoneticValue!=null && alternatePhoneticValue.length() > 0\n              && !alternatePhoneticValue.equals(primaryPhoneticValue)\n              && !primaryPhoneticValue.equals(v)) {\n        if (saveState) {\n          remainingTokens.addLast(captureState());\n          saveState = false;\n        }\n        posAtt.setPositionIncrement( firstAlternativeIncrement );\n        termAtt.setEmpty().append(alternatePhoneticValue);\n        saveState = true;\n      }\n\n      // Just one token to return, so no need to capture/restore\n      // any state, simply return it.\n      if (remainingTokens.isEmpty()) {\n        return true;\n      }\n\n      if (saveState) {\n        remainingTokens.addLast(captureState());\n      }\n    }\n  }",
-        "smell": "long_method",
-        "severity": "moderate"
-    },
-    {
-        "code_snippet": "@Entity\npublic class Car2 {\n  @Id\n  private String numberPlate;\n  \n  private String colour;\n  \n  private int engineSize;\n  \n  private int numberOfSeats;\n\n  public String getNumberPlate() {\n    return numberPlate;\n  }\n\n  public void setNumberPlate(String numberPlate) {\n    this.numberPlate = numberPlate;\n  }\n\n  public String getColour() {\n    return colour;\n  }\n\n  public void setColour(String colour) {\n    this.colour = colour;\n  }\n\n  public int getEngineSize() {\n    return engineSize;\n  }\n\n  public void setEngineSize(int engineSize) {\n    this.engineSize = engineSize;\n  }\n\n  public int getNumberOfSeats() {\n    return numberOfSeats;\n  }\n\n  public void setNumberOfSeats(int numberOfSeats) {\n    this.numberOfSeats = numberOfSeats;\n  }\n  \n  \n}",
-        "smell": "data_class",
-        "severity": "moderate"
-    },
-    {
-        "code_snippet": "@Override\n      public void read(org.apache.thrift.protocol.TProtocol prot, cancelCompaction_args struct) throws org.apache.thrift.TException {\n        org.apache.thrift.protocol.TTupleProtocol iprot = (org.apache.thrift.protocol.TTupleProtocol) prot;\n        java.util.BitSet incoming = iprot.readBitSet(2);\n        if (incoming.get(0)) {\n          struct.login = iprot.readBinary();\n          struct.setLoginIsSet(true);\n        }\n        if (incoming.get(1)) {\n          struct.tableName = iprot.readString();\n          struct.setTableNameIsSet(true);\n        }\n      }",
-        "smell": "feature_envy",
-        "severity": "minor"
-    }
-]
-
-def few_shot_prompt(examples):
-   
-    prompt = "You are a code analysis assistant. Below are examples of code snippets with identified code smells and severity.\n"
-    prompt += "Use this information to analyze the next code snippet and identify any code smell between:\n"
-    prompt += '"feature_envy", "long_method", "blob", "data_class". Additionally, rate the severity of the code smell as: "none", "minor", "moderate", or "severe."\n\n'
-
-    for i, example in enumerate(examples, start=1):
-        prompt += f"Example {i}:\n"
-        prompt += f"Code snippet:\n```\n{example['code_snippet']}\n```\n"
-        prompt += f"Smell: {example['smell']}, Severity: {example['severity']}\n\n"
-
-    return prompt
+MODEL = "gpt-4"
+CONTEXT_WINDOW = 8192
+TEMPERATURE = 0.7
+MAX_TOKENS = 50
+USER_PROMPT_PREFIX = "Code snippet : \n\n "
+# Each chat message carries ~4 tokens of framing, and the reply is primed with 3.
+CHAT_OVERHEAD_TOKENS = 2 * 4 + 3
+# Retried by the scheduler without cutting concurrency, as the SDK's own retries are disabled.
+TRANSIENT_ERRORS = (APIConnectionError, APITimeoutError, InternalServerError)
+
+budgeter = None
+snippet_tokens = None
+few_shot_index = None
+few_shot_k = DEFAULT_FEW_SHOT_K
+few_shot_tokens = DEFAULT_FEW_SHOT_TOKENS
+
+
+def get_budgeter():
+    global budgeter, snippet_tokens
+    if budgeter is None:
+        budgeter = TokenBudgeter.for_tiktoken(MODEL, CONTEXT_WINDOW)
+        if few_shot_index is None:
+            snippet_tokens = budgeter.snippet_budget(gpt_system_prompt(), USER_PROMPT_PREFIX,
+                                                     reserved=CHAT_OVERHEAD_TOKENS + MAX_TOKENS)
+        else:
+            snippet_tokens = budgeter.snippet_budget(few_shot_prompt([]), USER_PROMPT_PREFIX,
+                                                     reserved=CHAT_OVERHEAD_TOKENS + MAX_TOKENS + few_shot_tokens)
+    return budgeter
 
+def use_few_shot_index(index_dir, k=DEFAULT_FEW_SHOT_K, max_tokens=DEFAULT_FEW_SHOT_TOKENS):
+    """Pick the `k` nearest examples of a retrieval.py index, within `max_tokens`, instead of the fixed ones."""
+    global few_shot_index, few_shot_k, few_shot_tokens, budgeter
+    few_shot_index = FewShotIndex(index_dir)
+    few_shot_k = k
+    few_shot_tokens = max_tokens
+    # The snippet budget depends on the size of the few-shot block.
+    budgeter = None
+    logging.info(f"Retrieving {k} few-shot examples within {max_tokens} tokens from {len(few_shot_index)} in {index_dir}")
 
 def truncate_snippet(snippet):
-    """Truncate the code snippet to stay within the character limit."""
-    return snippet[:MAX_CHARS] if len(snippet) > MAX_CHARS else snippet
+    """Truncate the code snippet so that the whole request fits the model's context window."""
+    with span("tokenize"):
+        return get_budgeter().truncate(snippet, snippet_tokens)
 
-def load_existing_results(filepath):
-    if os.path.exists(filepath):
-        with open(filepath, "r") as file:
-            return json.load(file)
-    return []
+def split_snippet(snippet):
+    """Split an oversized snippet at method boundaries into pieces that each fit the context window."""
+    with span("tokenize"):
+        return get_budgeter().chunk(snippet, snippet_tokens)
 
-def save_results(results, filepath):
-    with open(filepath, "w") as file:
-        json.dump(results, file, indent=4)
+def system_prompt(code_snippet, unique_id=None):
+    """The fixed few-shot prompt, or one made of the examples nearest to the snippet (never its own)."""
+    if few_shot_index is None:
+        return gpt_system_prompt()
+    with span("retrieve", item=unique_id):
+        examples = few_shot_index.nearest(code_snippet, few_shot_k, few_shot_tokens,
+                                          lambda example: get_budgeter().count(format_example(few_shot_k, example)),
+                                          exclude_id=unique_id)
+    return few_shot_prompt(examples)
 
-def detect_smell_and_severity(code_snippet):
+def build_messages(code_snippet, unique_id=None):
     code_snippet = truncate_snippet(code_snippet)
     # Create the prompt with the code snippet
-    prompt = f"Code snippet : \n\n {code_snippet}"
-    retries = 10
-    for attempt in range(retries):
-        time.sleep(5)
-        try:
-            response = client.chat.completions.create(
-                model="gpt-4",
-                messages=[
-                    {"role": "system", "content": few_shot_prompt(examples=examples)},
-                    {"role": "user", "content": prompt}
-                ],
-                temperature=0.7,
-                max_tokens=50
-            )
-
-            message = response.choices[0].message.content
-            return message
-        except RateLimitError as e:
-            wait_time = (2 ** attempt) * 5
-            logging.warning(f"Rate limit exceeded. Retrying in {wait_time} seconds.")
-            time.sleep(wait_time)
-    raise Exception("Failed to complete requests after multiple retries.")
-
-def process_json(file_path, results_filepath, batch_size=20):
+    prompt = f"{USER_PROMPT_PREFIX}{code_snippet}"
+    return [
+        {"role": "system", "content": system_prompt(code_snippet, unique_id)},
+        {"role": "user", "content": prompt}
+    ]
+
+def count_request_tokens(messages, samples=1):
+    """Tokens a request counts against the tokens-per-minute limit: prompt plus completion budget."""
+    budgeter = get_budgeter()
+    return (sum(budgeter.count(message["content"]) for message in messages) + CHAT_OVERHEAD_TOKENS
+            + MAX_TOKENS * samples)
+
+def sampling_params(samples):
+    """Extra response cache key of self-consistency runs, whose cached value is the list of samples."""
+    return {"samples": samples} if samples > 1 else {}
+
+async def request_completion(messages, n=1):
+    global async_client
+    if async_client is None:
+        # Retries are left to the scheduler so that 429s feed its concurrency control.
+        async_client = AsyncOpenAI(max_retries=0)
+    return await async_client.chat.completions.create(
+        model=MODEL,
+        messages=messages,
+        temperature=TEMPERATURE,
+        max_tokens=MAX_TOKENS,
+        n=n
+    )
+
+async def sample_completions(entry, messages, n=1):
+    with span("model_call", item=entry['unique_id'], samples=n) as attrs:
+        response = await request_completion(messages, n=n)
+        if response.usage is not None:
+            attrs["prompt_tokens"] = response.usage.prompt_tokens
+            attrs["completion_tokens"] = response.usage.completion_tokens
+            count("prompt_tokens", response.usage.prompt_tokens)
+            count("completion_tokens", response.usage.completion_tokens)
+    return [choice.message.content for choice in response.choices]
+
+async def complete(item, cache, samples=1, scheduler=None):
+    """Return the cached answer for an (entry, messages, cached, drawn) item, or request and cache it.
+
+    With `samples` > 1 the answer is the list of sampled outputs, drawn `n=` at a
+    time in rounds until the majority is settled. Samples already drawn are kept
+    in the item's `drawn` list, so a retry after a rate limit continues from there.
+    Every round resends the prompt, so each one is charged to the `scheduler`'s
+    tokens-per-minute budget as it is sent.
+    """
+    entry, messages, cached, drawn = item
+    if cached is not None:
+        return cached
+    if samples == 1:
+        result = (await sample_completions(entry, messages))[0]
+    else:
+        round_size = next_round(drawn, samples)
+        while round_size:
+            if scheduler is not None:
+                await scheduler.charge(count_request_tokens(messages, round_size))
+            drawn.extend(await sample_completions(entry, messages, n=round_size))
+            round_size = next_round(drawn, samples)
+        count("samples_skipped", samples - len(drawn))
+        result = list(drawn)
+    if cache is not None:
+        cache.set(MODEL, messages, TEMPERATURE, MAX_TOKENS, result, **sampling_params(samples))
+    return result
+
+async def group_chunk_results(completions):
+    """Regroup the ordered (item, result) pairs of an entry's chunks into (entry, [results])."""
+    entry, results = None, []
+    async for (item_entry, *_), result in completions:
+        if entry is not None and item_entry is not entry:
+            yield entry, results
+            results = []
+        entry = item_entry
+        results.append(result)
+    if entry is not None:
+        yield entry, results
+
+async def classify_records(records, scheduler, cache=None, chunk=False, samples=1):
+    """Async generator of (entry, answer, votes) for `records`, a sync or async iterable, in input order.
+
+    The answer is None when every retry failed. Requests go through `scheduler`,
+    so a slow source only holds back the requests it has not produced yet.
+    With `samples` > 1 the answer is the majority of up to that many samples and
+    `votes` their distribution, otherwise `votes` is None.
+    """
+    async def requests_to_send():
+        async for entry in aiterate(records):
+            parts = split_snippet(entry['code_snippet']) if chunk else [entry['code_snippet']]
+            for part in parts:
+                with span("prompt_build", item=entry['unique_id']):
+                    messages = build_messages(part, entry['unique_id'])
+                    cached = (cache.get(MODEL, messages, TEMPERATURE, MAX_TOKENS, **sampling_params(samples))
+                              if cache else None)
+                yield entry, messages, cached, []
+
+    def cost_fn(item):
+        # Cached answers cost nothing against the tokens-per-minute budget, and
+        # self-consistency rounds are charged one by one in `complete`.
+        return 0 if item[2] is not None or samples > 1 else count_request_tokens(item[1])
+
+    completions = scheduler.map_ordered(lambda item: complete(item, cache, samples, scheduler), requests_to_send(),
+                                        cost_fn=cost_fn if scheduler.tokens_per_minute else None)
+
+    async for entry, chunk_results in group_chunk_results(completions):
+        with span("parse", item=entry['unique_id'], chunks=len(chunk_results)):
+            if samples > 1:
+                result, votes = vote_chunks(chunk_results)
+            else:
+                result = aggregate_verdicts(chunk_results) if len(chunk_results) > 1 else chunk_results[0]
+                votes = None
+        yield entry, result, votes
+
+async def process_json_async(file_path, results_filepath, batch_size=20, shard=None, smells=None,
+                             severities=None, concurrency=8, tokens_per_minute=None, chunk=False, use_cache=True,
+                             samples=1):
     existing_results = load_existing_results(results_filepath)
     processed_ids = {result['unique_id'] for result in existing_results}
 
-    results = existing_results  
-    
-    with open(file_path, 'r') as f:
-        data = json.load(f)
+    scheduler = AdaptiveScheduler(max_concurrency=concurrency, tokens_per_minute=tokens_per_minute,
+                                  rate_limit_errors=(RateLimitError,), transient_errors=TRANSIENT_ERRORS)
+    records = iter_records(file_path, shard=shard, smells=smells, severities=severities)
+    cache = get_response_cache() if use_cache else None
+
+    pending = []
+
+    with JsonlWriter(jsonl_path_for(results_filepath)) as writer, \
+            tqdm.tqdm(desc="Processing snippets") as pbar:
+
+        def pending_records():
+            for entry in records:
+                if entry['unique_id'] in processed_ids:
+                    pbar.update(1)
+                    continue
+                yield entry
+
+        # Answers already received are saved even if the run is interrupted.
+        try:
+            async for entry, result, votes in classify_records(pending_records(), scheduler, cache, chunk, samples):
+                if result is not None:
+                    pending.append({
+                        'unique_id': entry['unique_id'],
+                        'smell_and_severity': result
+                    })
+                    if votes is not None:
+                        pending[-1]['votes'] = votes
+
+                    logging.info(f"Processed snippet {entry['unique_id']}: Model Output: {result}, Correct: {entry['smell']}, {entry['severity']}")
+
+                if len(pending) >= batch_size:
+                    save_results(pending, writer)
+                    pending = []
 
-    with tqdm.tqdm(total=len(data), desc="Processing snippets") as pbar:
-        for i, entry in enumerate(data):
-            if entry['unique_id'] in processed_ids:
                 pbar.update(1)
-                continue
-
-            code_snippet = entry['code_snippet']
-            result = detect_smell_and_severity(code_snippet)
-            if result is not None:
-                results.append({
-                    'unique_id': entry['unique_id'],
-                    'smell_and_severity': result
-                })
-
-                correct_answer = entry.get('smell_and_severity', 'N/A')
-                logging.info(f"Processed snippet {entry['unique_id']}: Model Output: {result}, Correct: {entry['smell']}, {entry['severity']}")
-
-            if (i + 1) % batch_size == 0:
-                save_results(results, results_filepath)
-            
-            pbar.update(1)    
-            
-        print(f"Smell detection completed. Results saved to {results_filepath}")
+        finally:
+            save_results(pending, writer)
+
+    if scheduler.rate_limited:
+        logging.info(f"Hit the rate limit {scheduler.rate_limited} times, final concurrency {int(scheduler.limit)}")
+    if cache is not None:
+        cache.log_stats()
+    export_results(results_filepath)
+    print(f"Smell detection completed. Results saved to {results_filepath}")
+
+def process_json(file_path, results_filepath, batch_size=20, shard=None, smells=None, severities=None,
+                 concurrency=8, tokens_per_minute=None, chunk=False, use_cache=True, samples=1):
+    """Classify every pending snippet with up to `concurrency` requests in flight.
+
+    Concurrency backs off multiplicatively on rate-limit errors and recovers
+    additively; `tokens_per_minute` additionally budgets requests by their
+    tiktoken-estimated size. Results are written in dataset order.
+
+    Snippets too long for the context window are truncated to fit, or with `chunk`
+    split at method boundaries and classified piece by piece, keeping the most
+    severe verdict.
+
+    Responses are kept in a disk cache keyed by model, prompt and decoding
+    parameters, so a re-run only sends requests whose answers were never received.
+
+    With `samples` > 1 (self-consistency), up to that many answers are sampled per
+    snippet with `n=` and the majority is kept, along with the vote distribution.
+    """
+    asyncio.run(process_json_async(file_path, results_filepath, batch_size=batch_size, shard=shard, smells=smells,
+                                   severities=severities, concurrency=concurrency,
+                                   tokens_per_minute=tokens_per_minute, chunk=chunk, use_cache=use_cache,
+                                   samples=samples))
 
 if __name__ == '__main__':
-    json_file_path = 'MLCQCodeSmellSamples.json'
-    results_filepath = 'gpt4_results.json'
-    process_json(json_file_path, results_filepath)
+    parser = argparse.ArgumentParser()
+    add_dataset_arguments(parser)
+    parser.add_argument("--output", default='gpt4_results.json', help="Results file")
+    parser.add_argument("--concurrency", type=int, default=8, help="Maximum requests in flight")
+    parser.add_argument("--tpm", type=int, default=None, help="Tokens-per-minute budget of the API key")
+    parser.add_argument("--chunk", action="store_true",
+                        help="Split snippets that overflow the context window at method boundaries instead of truncating")
+    parser.add_argument("--no-cache", action="store_true", help="Do not read or write the response cache")
+    parser.add_argument("--samples", type=int, default=1,
+                        help="Self-consistency: vote over up to this many sampled answers per snippet")
+    add_few_shot_arguments(parser)
+    add_telemetry_arguments(parser)
+    args = parser.parse_args()
+    configure(args.trace, args.metrics_port)
+    if args.few_shot_index:
+        use_few_shot_index(args.few_shot_index, args.few_shot_k, args.few_shot_tokens)
+
+    results_filepath = shard_path(args.output, args.shard)
+    process_json(args.input, results_filepath, shard=args.shard, smells=args.smells, severities=args.severities,
+                 concurrency=args.concurrency, tokens_per_minute=args.tpm, chunk=args.chunk,
+                 use_cache=not args.no_cache, samples=args.samples)
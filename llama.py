@@ -1,129 +1,425 @@
 import transformers
 import torch
 import gc
-import json
+import argparse
+import copy
 import logging
 import os
 import tqdm
-import bitsandbytes as bnb  
+
+from storage import JsonlWriter, jsonl_path_for, load_existing_results, export_results, save_results
+from dataset import iter_records, add_dataset_arguments, shard_path
+from prompts import LLAMA_TEMPLATE
+from token_budget import TokenBudgeter, aggregate_verdicts
+from response_cache import get_response_cache
+from constrained import CANDIDATE_ANSWERS, candidate_token_ids, score_candidates, stopping_criteria
+from telemetry import span, count, configure, add_telemetry_arguments
+from voting import sample_until_settled, vote_chunks
 
 torch.cuda.empty_cache()
 gc.collect()
 
-model_id = "meta-llama/Meta-Llama-3.1-8B-Instruct"
-
-pipeline = transformers.pipeline(
-    "text-generation",
-    model=model_id,
-    model_kwargs={
-        "torch_dtype": torch.bfloat16,
-        "load_in_4bit": True,  
-        "bnb_4bit_quant_type": "nf4",  
-        "device_map": "auto" 
-    },
-)
-
-MAX_CHARS = 40000
-
-examples = [
-{
-        "code_snippet": "  @Override\n  public boolean incrementToken() throws IOException {\n    for(;;) {\n\n      if (!remainingTokens.isEmpty()) {\n        // clearAttributes();  // not currently necessary\n        restoreState(remainingTokens.removeFirst());\n        return true;\n      }\n\n      if (!input.incrementToken()) return false;\n\n      int len = termAtt.length();\n      if (len==0) return true; // pass through zero length terms\n      \n      int firstAlternativeIncrement = inject ? 0 : posAtt.getPositionIncrement();\n\n      String v = termAtt.toString();\n      String primaryPhoneticValue = encoder.doubleMetaphone(v);\n      String alternatePhoneticValue = encoder.doubleMetaphone(v, true);\n\n      // a flag to lazily save state if needed... this avoids a save/restore when only\n      // one token will be generated.\n      boolean saveState=inject;\n\n      if (primaryPhoneticValue!=null && primaryPhoneticValue.length() > 0 && !primaryPhoneticValue.equals(v)) {\n        if (saveState) {\n          remainingTokens.addLast(captureState());\n        }\n        posAtt.setPositionIncrement( firstAlternativeIncrement );\n        firstAlternativeIncrement = 0;\n        termAtt.setEmpty().append(primaryPhoneticValue);\n        saveState = true;\n      }\n\n      if (alternatePhoneticValue!=null && alternatePhoneticValue.length() > 0\n              && !alternatePhoneticValue.equals(primaryPhoneticValue)\n              && !primaryPhoneticValue.equals(v)) {\n        if (saveState) {\n          remainingTokens.addLast(captureState());\n          saveState = false;\n        }\n        posAtt.setPositionIncrement( firstAlternativeIncrement );\n        termAtt.setEmpty().append(alternatePhoneticValue);\n        saveState = true;\n      }\n\n      // Just one token to return, so no need to capture/restore\n      // any state, simply return it.\n      if (remainingTokens.isEmpty()) {\n        return true;\n      }\n\n      if (saveState) {\n        remainingTokens.addLast(captureState());\n      }\n    }\n  }",
-        "smell": "long_method",
-        "severity": "moderate"
-    },
-    {
-        "code_snippet": "@Entity\npublic class Car2 {\n  @Id\n  private String numberPlate;\n  \n  private String colour;\n  \n  private int engineSize;\n  \n  private int numberOfSeats;\n\n  public String getNumberPlate() {\n    return numberPlate;\n  }\n\n  public void setNumberPlate(String numberPlate) {\n    this.numberPlate = numberPlate;\n  }\n\n  public String getColour() {\n    return colour;\n  }\n\n  public void setColour(String colour) {\n    this.colour = colour;\n  }\n\n  public int getEngineSize() {\n    return engineSize;\n  }\n\n  public void setEngineSize(int engineSize) {\n    this.engineSize = engineSize;\n  }\n\n  public int getNumberOfSeats() {\n    return numberOfSeats;\n  }\n\n  public void setNumberOfSeats(int numberOfSeats) {\n    this.numberOfSeats = numberOfSeats;\n  }\n  \n  \n}",
-        "smell": "data_class",
-        "severity": "moderate"
-    },
-    {
-        "code_snippet": "@Override\n      public void read(org.apache.thrift.protocol.TProtocol prot, cancelCompaction_args struct) throws org.apache.thrift.TException {\n        org.apache.thrift.protocol.TTupleProtocol iprot = (org.apache.thrift.protocol.TTupleProtocol) prot;\n        java.util.BitSet incoming = iprot.readBitSet(2);\n        if (incoming.get(0)) {\n          struct.login = iprot.readBinary();\n          struct.setLoginIsSet(true);\n        }\n        if (incoming.get(1)) {\n          struct.tableName = iprot.readString();\n          struct.setTableNameIsSet(true);\n        }\n      }",
-        "smell": "feature_envy",
-        "severity": "minor"
-    }
-]
+model_id = os.getenv("LLAMA_MODEL_ID", "meta-llama/Meta-Llama-3.1-8B-Instruct")
+
+pipeline = None
+prefix_cache = None
+budgeter = None
+snippet_tokens = None
+
+TEMPERATURE = 0.7
+
+# Prompt + generated tokens allowed per snippet. Llama 3.1 accepts far more, this bounds memory use.
+CONTEXT_WINDOW = int(os.getenv("LLAMA_CONTEXT_WINDOW", "16384"))
+MAX_NEW_TOKENS = 150
+SNIPPET_INDENT = "    "
+
 logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(message)s",
                     handlers=[
                         logging.FileHandler('llama_model_results.log'),
                         logging.StreamHandler()
                     ])
 
+def get_budgeter():
+    global budgeter, snippet_tokens
+    if budgeter is None:
+        budgeter = TokenBudgeter.for_tokenizer(load_pipeline().tokenizer, CONTEXT_WINDOW)
+        snippet_tokens = budgeter.snippet_budget(LLAMA_TEMPLATE.prefix, SNIPPET_INDENT, LLAMA_TEMPLATE.suffix,
+                                                 reserved=MAX_NEW_TOKENS)
+    return budgeter
+
 def truncate_snippet(snippet):
-    """Truncate the code snippet to stay within the character limit."""
-    return snippet[:MAX_CHARS] if len(snippet) > MAX_CHARS else snippet
+    """Truncate the code snippet so that prompt and answer fit in CONTEXT_WINDOW tokens."""
+    with span("tokenize"):
+        return get_budgeter().truncate(snippet, snippet_tokens)
 
-def load_existing_results(filepath):
-    if os.path.exists(filepath):
-        with open(filepath, "r") as file:
-            return json.load(file)
-    return []
+def split_snippet(snippet):
+    """Split an oversized snippet at method boundaries into pieces that each fit CONTEXT_WINDOW."""
+    with span("tokenize"):
+        return get_budgeter().chunk(snippet, snippet_tokens)
 
-def save_results(results, filepath):
-    with open(filepath, "w") as file:
-        json.dump(results, file, indent=4)
+def load_pipeline(model_name=None):
+    """Load the text-generation pipeline once, 4-bit quantized on GPU or in float32 on CPU."""
+    global pipeline
+    if pipeline is not None:
+        return pipeline
 
-def detect_smell_and_severity(code_snippet):
-    code_snippet = truncate_snippet(code_snippet)
-    
-    prompt = f"""
-    You are a code analysis assistant. Please analyze the following code snippet and identify any code smell between:
-    "feature_envy", "long_method", "blob", "data_class". 
-    Additionally, rate the severity of the code smell as: "none", "minor", "moderate", or "severe."
-
-    Code snippet:
-    ```
-    {code_snippet}
-    ```
-
-    Provide your response in the exact format: "Smell: <name>, Severity: <severity>"
-    """
-    
-    outputs = pipeline(
-        prompt,
-        max_new_tokens=150,
-        do_sample=True,
-        temperature=0.7,
+    if torch.cuda.is_available():
+        model_kwargs = {
+            "torch_dtype": torch.bfloat16,
+            "load_in_4bit": True,  
+            "bnb_4bit_quant_type": "nf4",  
+            "device_map": "auto" 
+        }
+    else:
+        model_kwargs = {"torch_dtype": torch.float32}
+
+    pipeline = transformers.pipeline(
+        "text-generation",
+        model=model_name or model_id,
+        model_kwargs=model_kwargs,
     )
-    
-    generated_text = outputs[0]["generated_text"]
-    
-    return generated_text[len(prompt):].strip()
 
-def process_json(file_path, results_filepath='llama_8bits_results.json', batch_size=20):
-    existing_results = load_existing_results(results_filepath)
-    processed_ids = {result['unique_id'] for result in existing_results}
+    # Batched generation with a decoder-only model needs left padding.
+    tokenizer = pipeline.tokenizer
+    tokenizer.padding_side = "left"
+    if tokenizer.pad_token is None:
+        tokenizer.pad_token = tokenizer.eos_token
+    return pipeline
 
-    results = existing_results
+def build_prompt(code_snippet):
+    with span("prompt_build"):
+        return LLAMA_TEMPLATE.render(snippet_text(code_snippet))
 
-    with open(file_path, 'r') as f:
-        data = json.load(f)
+def snippet_text(code_snippet):
+    """The part of the prompt that follows the static prefix."""
+    return SNIPPET_INDENT + truncate_snippet(code_snippet)
 
-    with tqdm.tqdm(total=len(data), desc="Processing snippets") as pbar:
-        for i, entry in enumerate(data):
-            if entry['unique_id'] in processed_ids:
-                pbar.update(1)  
-                continue
+class PrefixCache:
+    """KV cache of the static prompt prefix, prefilled once and reused for every batch.
+
+    Each batch only prefills what follows the prefix: the cached prefix is copied,
+    repeated across the batch and handed to `generate`. The rest of each prompt is
+    left padded after the prefix, and the attention mask hides the padding in between.
+    """
+
+    def __init__(self, model, tokenizer, prefix):
+        self.model = model
+        self.tokenizer = tokenizer
+        # The last token of the prefix may merge with the start of the snippet (with
+        # byte-level BPE the final newline and the snippet's indentation are one
+        # token), so it is prefilled with each snippet instead of being cached.
+        self.prefix_ids = tokenizer(prefix, return_tensors="pt").input_ids[:, :-1].to(model.device)
+        self.prefix_list = self.prefix_ids[0].tolist()
+        self.cache = transformers.DynamicCache()
+        with torch.no_grad(), span("prefill", prompt_tokens=self.prefix_ids.shape[1]):
+            model(self.prefix_ids, past_key_values=self.cache, use_cache=True)
+
+    def __len__(self):
+        return self.prefix_ids.shape[1]
+
+    def remainder(self, prompt_ids):
+        """Token ids of a whole prompt after the cached prefix, or None if the prompt
+        does not start with exactly the cached tokens."""
+        if prompt_ids[:len(self)] != self.prefix_list:
+            return None
+        return prompt_ids[len(self):]
+
+    def cache_for(self, batch_size):
+        cache = copy.deepcopy(self.cache)
+        if batch_size > 1:
+            cache.batch_repeat_interleave(batch_size)
+        return cache
+
+    def generate(self, prompts, **generate_kwargs):
+        """Generate for whole prompts, tokenized as one string each so that the ids
+        are those of a full prefill. A batch with a prompt that does not start with
+        the cached tokens is prefilled in full."""
+        encoded = self.tokenizer(prompts)["input_ids"]
+        rests = [self.remainder(ids) for ids in encoded]
+        if any(rest is None for rest in rests):
+            count("prefix_cache_misses", len(prompts))
+            cache, rows, prefix = None, encoded, []
+        else:
+            cache, rows, prefix = self.cache_for(len(prompts)), rests, self.prefix_list
+        width = max(len(row) for row in rows)
+        pad = [self.tokenizer.pad_token_id] * width
+        input_ids = torch.tensor([prefix + pad[:width - len(row)] + row for row in rows], device=self.model.device)
+        attention_mask = torch.tensor([[1] * len(prefix) + [0] * (width - len(row)) + [1] * len(row) for row in rows],
+                                      device=self.model.device)
+        with torch.no_grad():
+            output = self.model.generate(input_ids=input_ids, attention_mask=attention_mask,
+                                         past_key_values=cache, **generate_kwargs)
+        return self.tokenizer.batch_decode(output[:, input_ids.shape[1]:], skip_special_tokens=True)
+
+def load_prefix_cache():
+    global prefix_cache
+    if prefix_cache is None:
+        pipe = load_pipeline()
+        prefix_cache = PrefixCache(pipe.model, pipe.tokenizer, LLAMA_TEMPLATE.prefix)
+    return prefix_cache
+
+def bucket_by_length(lengths, batch_size, max_batch_tokens, max_new_tokens=MAX_NEW_TOKENS):
+    """Split item indices into batches of similar token length.
+
+    Items are sorted by length so each batch pads little, and a batch is closed once
+    it holds `batch_size` items or its padded size (items x (longest prompt +
+    `max_new_tokens`)) would exceed `max_batch_tokens`. An item that alone exceeds
+    the budget still gets a batch of its own.
+    """
+    batches = []
+    batch = []
+    for index in sorted(range(len(lengths)), key=lambda i: lengths[i]):
+        padded = (len(batch) + 1) * (lengths[index] + max_new_tokens)
+        if batch and (len(batch) >= batch_size or padded > max_batch_tokens):
+            batches.append(batch)
+            batch = []
+        batch.append(index)
+    if batch:
+        batches.append(batch)
+    return batches
+
+def detect_smell_and_severity_batch(code_snippets, batch_size=8, max_batch_tokens=32768,
+                                    max_new_tokens=MAX_NEW_TOKENS, use_prefix_cache=True, use_cache=True,
+                                    constrained=False, samples=1):
+    """Run many snippets through the model in length-bucketed, padded batches.
+
+    Results are returned in the order of `code_snippets`, without the echoed prompt.
+    With `use_prefix_cache` the static instructions are prefilled once for the
+    whole run and only the snippet tokens are prefilled per batch. With
+    `use_cache` only prompts missing from the response cache are generated.
+    With `constrained` nothing is generated: the answer is the most likely of
+    the 16 valid "Smell: X, Severity: Y" completions. With `samples` > 1 each
+    result is instead the list of answers sampled for self-consistency voting.
+    """
+    if constrained and samples > 1:
+        raise ValueError("Self-consistency votes over sampled answers, it cannot be combined with constrained scoring")
+
+    def compute(snippets):
+        if constrained:
+            return classify_constrained(snippets, use_prefix_cache)
+        if samples > 1:
+            return sample_until_settled(
+                lambda items, counts: sample_batch(items, counts, batch_size, max_batch_tokens, max_new_tokens,
+                                                   use_prefix_cache),
+                snippets, samples)
+        return generate_batch(snippets, batch_size, max_batch_tokens, max_new_tokens, use_prefix_cache)
 
-            code_snippet = entry['code_snippet']
-            result = detect_smell_and_severity(code_snippet)
+    if not use_cache:
+        return compute(code_snippets)
 
+    cache = get_response_cache()
+    model_name = load_pipeline().model.name_or_path
+    params = {"constrained": True} if constrained else {"samples": samples} if samples > 1 else {}
+    prompts = [build_prompt(code_snippet) for code_snippet in code_snippets]
+    results = [cache.get(model_name, prompt, TEMPERATURE, max_new_tokens, **params) for prompt in prompts]
+
+    # Identical prompts within the batch are generated once too.
+    missing = {}
+    for i, result in enumerate(results):
+        if result is None:
+            missing.setdefault(prompts[i], []).append(i)
+    if missing:
+        first = [indices[0] for indices in missing.values()]
+        outputs = compute([code_snippets[i] for i in first])
+        for indices, output in zip(missing.values(), outputs):
+            for i in indices:
+                results[i] = output
+            cache.set(model_name, prompts[indices[0]], TEMPERATURE, max_new_tokens, output, **params)
+    return results
+
+def classify_constrained(code_snippets, use_prefix_cache=True):
+    """Pick, for each snippet, the most likely of the valid answers in one scoring pass."""
+    pipe = load_pipeline()
+    tokenizer = pipe.tokenizer
+    candidate_ids, candidate_mask = candidate_token_ids(tokenizer)
+
+    results = []
+    for code_snippet in code_snippets:
+        prompt_ids = tokenizer(build_prompt(code_snippet))["input_ids"]
+        cache = None
+        if use_prefix_cache:
+            prefix = load_prefix_cache()
+            rest = prefix.remainder(prompt_ids)
+            if rest is None:
+                count("prefix_cache_misses")
+            else:
+                prompt_ids, cache = rest, prefix.cache_for(1)
+        prompt_ids = torch.tensor([prompt_ids])
+        with span("model_call", batch=1, prompt_tokens=prompt_ids.shape[1]):
+            scores = score_candidates(pipe.model, prompt_ids, candidate_ids, candidate_mask, cache)
+        count("prompt_tokens", prompt_ids.shape[1])
+        results.append(CANDIDATE_ANSWERS[int(scores.argmax())])
+    return results
+
+def generate_batch(code_snippets, batch_size, max_batch_tokens, max_new_tokens, use_prefix_cache):
+    pipe = load_pipeline()
+    prompts = [build_prompt(code_snippet) for code_snippet in code_snippets]
+    with span("tokenize", items=len(prompts)):
+        lengths = [len(ids) for ids in pipe.tokenizer(prompts)["input_ids"]]
+
+    if use_prefix_cache:
+        cache = load_prefix_cache()
+        results = [None] * len(prompts)
+        for batch in bucket_by_length(lengths, batch_size, max_batch_tokens, max_new_tokens):
+            prompt_tokens = sum(lengths[i] for i in batch)
+            with span("model_call", batch=len(batch), prompt_tokens=prompt_tokens):
+                outputs = cache.generate(
+                    [prompts[i] for i in batch],
+                    max_new_tokens=max_new_tokens,
+                    do_sample=True,
+                    temperature=TEMPERATURE,
+                    pad_token_id=pipe.tokenizer.pad_token_id,
+                    stopping_criteria=stopping_criteria(pipe.tokenizer),
+                )
+            count("prompt_tokens", prompt_tokens)
+            for i, output in zip(batch, outputs):
+                results[i] = output.strip()
+        return results
+
+    results = [None] * len(prompts)
+    for batch in bucket_by_length(lengths, batch_size, max_batch_tokens, max_new_tokens):
+        prompt_tokens = sum(lengths[i] for i in batch)
+        with span("model_call", batch=len(batch), prompt_tokens=prompt_tokens):
+            outputs = pipe(
+                [prompts[i] for i in batch],
+                batch_size=len(batch),
+                max_new_tokens=max_new_tokens,
+                do_sample=True,
+                temperature=TEMPERATURE,
+                return_full_text=False,
+                pad_token_id=pipe.tokenizer.pad_token_id,
+                stopping_criteria=stopping_criteria(pipe.tokenizer),
+            )
+        count("prompt_tokens", prompt_tokens)
+        for i, output in zip(batch, outputs):
+            results[i] = output[0]["generated_text"].strip()
+    return results
+
+def sample_batch(code_snippets, counts, batch_size, max_batch_tokens, max_new_tokens, use_prefix_cache):
+    """Draw counts[i] sampled answers for each snippet, returned as one list per snippet.
+
+    Each snippet is repeated in the batch, which is what `num_return_sequences`
+    does inside `generate`, but also works on top of the prefix cache. Copies
+    have the same length, so they share a bucket without padding.
+    """
+    repeated = [code_snippet for code_snippet, n in zip(code_snippets, counts) for _ in range(n)]
+    outputs = generate_batch(repeated, batch_size, max_batch_tokens, max_new_tokens, use_prefix_cache)
+    grouped, start = [], 0
+    for n in counts:
+        grouped.append(outputs[start:start + n])
+        start += n
+    return grouped
+
+def detect_smell_and_severity(code_snippet):
+    return detect_smell_and_severity_batch([code_snippet], batch_size=1)[0]
+
+def classify_window(window, inference_batch_size=8, max_batch_tokens=32768, use_prefix_cache=True, chunk=False,
+                    use_cache=True, constrained=False, samples=1):
+    """(answer, votes) for each of a list of dataset entries, bucketed by length across the whole list.
+
+    `votes` is the distribution of the sampled answers with `samples` > 1, None otherwise.
+    """
+    parts, owners = [], []
+    for index, entry in enumerate(window):
+        entry_parts = split_snippet(entry['code_snippet']) if chunk else [entry['code_snippet']]
+        parts.extend(entry_parts)
+        owners.extend([index] * len(entry_parts))
+
+    outputs = detect_smell_and_severity_batch(parts,
+                                              batch_size=inference_batch_size,
+                                              max_batch_tokens=max_batch_tokens,
+                                              use_prefix_cache=use_prefix_cache,
+                                              use_cache=use_cache,
+                                              constrained=constrained,
+                                              samples=samples)
+    chunk_outputs = [[] for _ in window]
+    for index, output in zip(owners, outputs):
+        chunk_outputs[index].append(output)
+
+    results = []
+    for entry, entry_outputs in zip(window, chunk_outputs):
+        with span("parse", item=entry['unique_id'], chunks=len(entry_outputs)):
+            if samples > 1:
+                results.append(vote_chunks(entry_outputs))
+            else:
+                results.append((aggregate_verdicts(entry_outputs) if len(entry_outputs) > 1 else entry_outputs[0],
+                                None))
+    return results
+
+def process_json(file_path, results_filepath='llama_8bits_results.json', batch_size=64,
+                 shard=None, smells=None, severities=None, inference_batch_size=8, max_batch_tokens=32768,
+                 use_prefix_cache=True, chunk=False, use_cache=True, constrained=False, samples=1):
+    existing_results = load_existing_results(results_filepath)
+    processed_ids = {result['unique_id'] for result in existing_results}
+
+    records = iter_records(file_path, shard=shard, smells=smells, severities=severities)
+
+    def run_window(window, writer):
+        # Each window of `batch_size` entries is bucketed by length, then saved.
+        results = classify_window(window, inference_batch_size, max_batch_tokens, use_prefix_cache, chunk,
+                                  use_cache, constrained, samples)
+        pending = []
+        for entry, (result, votes) in zip(window, results):
             if result is not None:
-                results.append({
+                pending.append({
                     'unique_id': entry['unique_id'],
                     'smell_and_severity': result
                 })
+                if votes is not None:
+                    pending[-1]['votes'] = votes
 
-                correct_answer = entry.get('smell_and_severity', 'N/A')
                 logging.info(f"Processed snippet {entry['unique_id']}: Model Output: {result}, Correct: {entry['smell']}, {entry['severity']}")
+        save_results(pending, writer)
 
-            if (i + 1) % batch_size == 0:
-                save_results(results, results_filepath)
-            
-            pbar.update(1)  
-        
-        save_results(results, results_filepath)
-        print("Smell detection completed. Results saved.")
+    window = []
+    with JsonlWriter(jsonl_path_for(results_filepath)) as writer, \
+            tqdm.tqdm(desc="Processing snippets") as pbar:
+        for entry in records:
+            if entry['unique_id'] in processed_ids:
+                pbar.update(1)
+                continue
+
+            window.append(entry)
+            if len(window) == batch_size:
+                run_window(window, writer)
+                pbar.update(len(window))
+                window = []
+
+        if window:
+            run_window(window, writer)
+            pbar.update(len(window))
+
+    if use_cache:
+        get_response_cache().log_stats()
+    export_results(results_filepath)
+    print(f"Smell detection completed. Results saved to {results_filepath}")
 
 if __name__ == '__main__':
-    json_file_path = 'MLCQCodeSmellSamples.json'
-    process_json(json_file_path)
+    parser = argparse.ArgumentParser()
+    add_dataset_arguments(parser)
+    parser.add_argument("--output", default='llama_8bits_results.json', help="Results file")
+    parser.add_argument("--model", default=model_id, help="Hugging Face model id or local path")
+    parser.add_argument("--batch-size", type=int, default=8, help="Snippets per generation batch")
+    parser.add_argument("--max-batch-tokens", type=int, default=32768,
+                        help="Upper bound on padded prompt + generated tokens per batch")
+    parser.add_argument("--no-prefix-cache", action="store_true",
+                        help="Prefill the whole prompt for every batch instead of reusing the instructions' KV cache")
+    parser.add_argument("--chunk", action="store_true",
+                        help="Split snippets that overflow the context window at method boundaries instead of truncating")
+    parser.add_argument("--no-cache", action="store_true", help="Do not read or write the response cache")
+    parser.add_argument("--constrained", action="store_true",
+                        help="Score the 16 valid answers instead of generating free text")
+    parser.add_argument("--samples", type=int, default=1,
+                        help="Self-consistency: vote over up to this many sampled answers per snippet")
+    add_telemetry_arguments(parser)
+    args = parser.parse_args()
+    if args.constrained and args.samples > 1:
+        parser.error("--samples votes over sampled answers and cannot be combined with --constrained")
+    configure(args.trace, args.metrics_port)
+
+    load_pipeline(args.model)
+    results_filepath = shard_path(args.output, args.shard)
+    process_json(args.input, results_filepath, shard=args.shard, smells=args.smells, severities=args.severities,
+                 inference_batch_size=args.batch_size, max_batch_tokens=args.max_batch_tokens,
+                 use_prefix_cache=not args.no_prefix_cache, chunk=args.chunk, use_cache=not args.no_cache,
+                 constrained=args.constrained, samples=args.samples)
@@ -0,0 +1,172 @@
+"""Local stand-ins for raw.githubusercontent.com and the OpenAI chat completions API.
+
+Both run in a background thread on 127.0.0.1 and are used by benchmark.py, but can
+also be started on their own to point DataExtractor.py (`base_url`) or gpt4.py
+(`OPENAI_BASE_URL`) at them.
+"""
+import http.server
+import json
+import random
+import threading
+import time
+
+# The 16 answers constrained.py accepts, spelled out here so the servers do not import torch.
+ANSWERS = [f"Smell: {smell}, Severity: {severity}"
+           for smell in ("feature_envy", "long_method", "blob", "data_class")
+           for severity in ("none", "minor", "moderate", "severe")]
+
+
+class MockServer:
+    """Threaded HTTP server running in the background, usable as a context manager."""
+
+    handler_class = None
+
+    def __init__(self, port=0):
+        self.server = http.server.ThreadingHTTPServer(("127.0.0.1", port), self.handler_class)
+        self.server.daemon_threads = True
+        self.server.mock = self
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.lock = threading.Lock()
+        self.requests = 0
+
+    @property
+    def url(self):
+        return f"http://127.0.0.1:{self.server.server_port}"
+
+    def start(self):
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+
+class QuietHandler(http.server.BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    # Headers and body are written separately, Nagle would hold the body back for a delayed ACK.
+    disable_nagle_algorithm = True
+
+    def log_message(self, format, *args):
+        pass
+
+    def send_body(self, status, body, content_type="application/json", headers=None):
+        data = body.encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(data)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, str(value))
+        self.end_headers()
+        self.wfile.write(data)
+
+
+class RawFileHandler(QuietHandler):
+
+    def do_GET(self):
+        mock = self.server.mock
+        with mock.lock:
+            mock.requests += 1
+        if mock.latency:
+            time.sleep(mock.latency)
+        text = mock.files.get(self.path.lstrip("/"))
+        headers = {"X-RateLimit-Remaining": 10 ** 6, "X-RateLimit-Reset": int(time.time()) + 3600}
+        if text is None:
+            self.send_body(404, "404: Not Found", "text/plain", headers)
+        else:
+            self.send_body(200, text, "text/plain; charset=utf-8", headers)
+
+
+class RawFileServer(MockServer):
+    """Serves `files`, a dict of "owner/repo/commit/path" to file text, like the raw endpoint."""
+
+    handler_class = RawFileHandler
+
+    def __init__(self, files, latency=0.0, port=0):
+        super().__init__(port)
+        self.files = files
+        self.latency = latency
+
+
+class ChatCompletionsHandler(QuietHandler):
+
+    def do_POST(self):
+        mock = self.server.mock
+        body = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))) or b"{}")
+
+        with mock.lock:
+            mock.requests += 1
+            mock.in_flight += 1
+            in_flight = mock.in_flight
+        try:
+            if (mock.max_concurrency and in_flight > mock.max_concurrency) or mock.random.random() < mock.error_rate:
+                with mock.lock:
+                    mock.rate_limited += 1
+                error = {"error": {"message": "Rate limit reached", "type": "requests", "code": "rate_limit_exceeded"}}
+                self.send_body(429, json.dumps(error), headers={"Retry-After": 1})
+                return
+
+            time.sleep(mock.random.uniform(0.5, 1.5) * mock.latency)
+            n = body.get("n", 1)
+            choices = [{"index": i, "finish_reason": "stop",
+                        "message": {"role": "assistant", "content": mock.random.choice(ANSWERS)}}
+                       for i in range(n)]
+            prompt_tokens = sum(len(message.get("content", "")) // 4 for message in body.get("messages", []))
+            response = {
+                "id": f"chatcmpl-{mock.requests}",
+                "object": "chat.completion",
+                "created": int(time.time()),
+                "model": body.get("model", "mock"),
+                "choices": choices,
+                "usage": {"prompt_tokens": prompt_tokens, "completion_tokens": 10 * n,
+                          "total_tokens": prompt_tokens + 10 * n},
+            }
+            self.send_body(200, json.dumps(response))
+        finally:
+            with mock.lock:
+                mock.in_flight -= 1
+
+
+class ChatCompletionsServer(MockServer):
+    """OpenAI-compatible /v1/chat/completions returning random valid answers.
+
+    Each request sleeps `latency` seconds (+-50%). A request is answered with a
+    429 with probability `error_rate`, or whenever more than `max_concurrency`
+    requests are in flight.
+    """
+
+    handler_class = ChatCompletionsHandler
+
+    def __init__(self, latency=0.05, error_rate=0.0, max_concurrency=None, seed=0, port=0):
+        super().__init__(port)
+        self.latency = latency
+        self.error_rate = error_rate
+        self.max_concurrency = max_concurrency
+        self.random = random.Random(seed)
+        self.in_flight = 0
+        self.rate_limited = 0
+
+    @property
+    def base_url(self):
+        return self.url + "/v1"
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Run the mock chat completions server in the foreground")
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument("--latency", type=float, default=0.05)
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    parser.add_argument("--max-concurrency", type=int, default=None)
+    args = parser.parse_args()
+
+    server = ChatCompletionsServer(args.latency, args.error_rate, args.max_concurrency, port=args.port)
+    print(f"Serving chat completions on {server.base_url}")
+    server.server.serve_forever()
@@ -0,0 +1,265 @@
+"""Single entry point streaming the CSV through fetching, inference and scoring at once.
+
+A fetch thread downloads snippets as DataExtractor.py does and hands them over
+through a bounded queue; the model (gpt4 or llama) classifies them as they come;
+a scoring thread saves each answer and keeps running precision/recall/F1. The
+queues are bounded so a fast stage waits for a slow one instead of piling up
+records in memory, and the wall-clock time approaches that of the slowest stage.
+
+    python pipeline.py --backend gpt4 --concurrency 16
+    python pipeline.py --backend llama --model meta-llama/Meta-Llama-3.1-8B-Instruct
+"""
+import argparse
+import asyncio
+import logging
+import os
+import queue
+import threading
+import time
+
+import tqdm
+
+from DataExtractor import iter_csv_rows, fetch_rows, make_fetcher
+from compute_metrics import RunningMetrics, log_report, SMELLS
+from dataset import add_dataset_arguments, in_shard, normalize_label, shard_path
+from fetch_engine import RAW_BASE_URL, DEFAULT_REQUESTS_PER_HOUR
+from file_cache import FileCache, DEFAULT_CACHE_DIR
+from retrieval import add_few_shot_arguments
+from storage import JsonlWriter, jsonl_path_for, compact_jsonl, export_json_array, load_existing_results, \
+    export_results
+from telemetry import configure, add_telemetry_arguments
+
+logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(message)s")
+
+# Marks the end of a queue.
+DONE = None
+
+
+def selected_rows(csv_file, shard=None, smells=None, severities=None):
+    """CSV rows, as parsed by DataExtractor, restricted like dataset.iter_records."""
+    smells = {normalize_label(smell) for smell in smells} if smells else None
+    severities = {normalize_label(severity) for severity in severities} if severities else None
+    with open(csv_file, "r") as f:
+        for row in iter_csv_rows(f):
+            if shard is not None and not in_shard(row["id"], shard):
+                continue
+            if smells is not None and normalize_label(row["smell"]) not in smells:
+                continue
+            if severities is not None and normalize_label(row["severity"]) not in severities:
+                continue
+            yield row
+
+
+def fetch_stage(rows, fetcher, cache, snippets, dataset_writer, save_every=50):
+    """Producer: fetch each row's snippet, log it to the dataset and pass it on."""
+    pending = []
+    try:
+        for row, code_snippet in fetch_rows(rows, fetcher, cache):
+            if not code_snippet:
+                continue
+            record = {**row, "code_snippet": code_snippet}
+            pending.append(record)
+            if len(pending) >= save_every:
+                dataset_writer.write_batch(pending)
+                pending = []
+            snippets.put({**record, "unique_id": row["id"]})
+    except Exception:
+        logging.exception("Fetch stage failed, finishing with the snippets fetched so far")
+    finally:
+        dataset_writer.write_batch(pending)
+        snippets.put(DONE)
+
+
+def take_window(snippets, size, max_wait):
+    """Block for one record, then gather up to `size` within `max_wait` seconds.
+
+    Returns the window and whether the end of the stream was reached.
+    """
+    record = snippets.get()
+    if record is DONE:
+        return [], True
+    window = [record]
+    deadline = time.monotonic() + max_wait
+    while len(window) < size:
+        try:
+            record = snippets.get(timeout=max(0.0, deadline - time.monotonic()))
+        except queue.Empty:
+            break
+        if record is DONE:
+            return window, True
+        window.append(record)
+    return window, False
+
+
+def llama_stage(snippets, answers, config):
+    import llama
+    llama.load_pipeline(config["model"])
+    finished = False
+    while not finished:
+        window, finished = take_window(snippets, config["window"], config["max_wait"])
+        if not window:
+            continue
+        results = llama.classify_window(window, config["batch_size"], config["max_batch_tokens"],
+                                        chunk=config["chunk"], use_cache=config["use_cache"],
+                                        constrained=config["constrained"], samples=config["samples"])
+        for entry, (result, votes) in zip(window, results):
+            answers.put((entry, result, votes))
+
+
+def gpt4_stage(snippets, answers, config):
+    import gpt4
+    from openai import RateLimitError
+    from scheduler import AdaptiveScheduler
+
+    if config.get("few_shot_index"):
+        gpt4.use_few_shot_index(config["few_shot_index"], config["few_shot_k"], config["few_shot_tokens"])
+
+    async def records():
+        while True:
+            record = await asyncio.to_thread(snippets.get)
+            if record is DONE:
+                return
+            yield record
+
+    async def run():
+        scheduler = AdaptiveScheduler(max_concurrency=config["concurrency"],
+                                      tokens_per_minute=config["tokens_per_minute"],
+                                      rate_limit_errors=(RateLimitError,),
+                                      transient_errors=gpt4.TRANSIENT_ERRORS)
+        cache = gpt4.get_response_cache() if config["use_cache"] else None
+        async for answer in gpt4.classify_records(records(), scheduler, cache, config["chunk"], config["samples"]):
+            await asyncio.to_thread(answers.put, answer)
+        if cache is not None:
+            cache.log_stats()
+
+    asyncio.run(run())
+
+
+BACKENDS = {"gpt4": gpt4_stage, "llama": llama_stage}
+
+
+def score_stage(answers, writer, metrics, pbar, save_every=20, report_every=100):
+    """Consumer: save answers and update the running metrics."""
+    pending = []
+    while True:
+        answer = answers.get()
+        if answer is DONE:
+            break
+        entry, result, votes = answer
+        pbar.update(1)
+        if result is None:
+            continue
+        pending.append({'unique_id': entry['unique_id'], 'smell_and_severity': result})
+        if votes is not None:
+            pending[-1]['votes'] = votes
+        metrics.update(entry['smell'], entry['severity'], result)
+        if len(pending) >= save_every:
+            writer.write_batch(pending)
+            pending = []
+
+        count = int(metrics.confusion.sum())
+        if count % report_every == 0:
+            report = metrics.report()
+            pbar.set_postfix(macro_f1=f"{report['macro_f1']:.3f}")
+            logging.info(f"After {count} answers: macro F1 {report['macro_f1']:.4f}, " + ", ".join(
+                f"{smell} P/R/F1 {p:.2f}/{r:.2f}/{f:.2f}"
+                for smell, p, r, f in zip(SMELLS, report['precision'], report['recall'], report['f1'])))
+    writer.write_batch(pending)
+
+
+def run(csv_file, results_filepath, dataset_filepath, backend="gpt4", shard=None, smells=None, severities=None,
+        fetch_concurrency=8, requests_per_hour=DEFAULT_REQUESTS_PER_HOUR, base_url=RAW_BASE_URL,
+        cache_dir=DEFAULT_CACHE_DIR, mirrors_dir=None, queue_size=256, report_every=100, n_bootstrap=1000,
+        **backend_config):
+    """Fetch, classify and score the CSV's rows concurrently, resuming after the rows already answered."""
+    existing_results = load_existing_results(results_filepath)
+    answered = {result['unique_id']: result['smell_and_severity'] for result in existing_results}
+
+    # Answers from earlier runs count towards the metrics without being fetched again.
+    metrics = RunningMetrics()
+    for row in selected_rows(csv_file, shard, smells, severities):
+        if row["id"] in answered:
+            metrics.update(row["smell"], row["severity"], answered[row["id"]])
+    if answered:
+        logging.info(f"Resuming after {int(metrics.confusion.sum())} answered rows")
+
+    fetcher = make_fetcher(fetch_concurrency, requests_per_hour, base_url, mirrors_dir)
+    cache = FileCache(cache_dir) if cache_dir and not mirrors_dir else None
+    snippets = queue.Queue(maxsize=queue_size)
+    answers = queue.Queue(maxsize=queue_size)
+    rows = (row for row in selected_rows(csv_file, shard, smells, severities) if row["id"] not in answered)
+
+    with JsonlWriter(jsonl_path_for(dataset_filepath)) as dataset_writer, \
+            JsonlWriter(jsonl_path_for(results_filepath)) as writer, \
+            tqdm.tqdm(desc="Pipeline") as pbar:
+        fetcher_thread = threading.Thread(target=fetch_stage, args=(rows, fetcher, cache, snippets, dataset_writer),
+                                          daemon=True)
+        scorer_thread = threading.Thread(target=score_stage, args=(answers, writer, metrics, pbar),
+                                         kwargs={"report_every": report_every}, daemon=True)
+        fetcher_thread.start()
+        scorer_thread.start()
+        try:
+            BACKENDS[backend](snippets, answers, backend_config)
+        finally:
+            answers.put(DONE)
+            scorer_thread.join()
+        fetcher_thread.join()
+
+    fetcher.close()
+    compact_jsonl(jsonl_path_for(dataset_filepath), key="id")
+    export_json_array(jsonl_path_for(dataset_filepath), dataset_filepath)
+    export_results(results_filepath)
+    log_report(results_filepath, metrics.report(n_bootstrap))
+    print(f"Pipeline completed. Results saved to {results_filepath}, snippets to {dataset_filepath}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Fetch, classify and score in one streaming run")
+    add_dataset_arguments(parser, default_input="MLCQCodeSmellSamples.csv")
+    parser.add_argument("--backend", choices=sorted(BACKENDS), default="gpt4")
+    parser.add_argument("--output", default=None, help="Results file (default: <backend>_pipeline_results.json)")
+    parser.add_argument("--dataset-output", default="pipeline_samples.json",
+                        help="Where the fetched snippets are saved, in DataExtractor's format")
+    parser.add_argument("--fetch-concurrency", type=int, default=int(os.getenv("FETCH_CONCURRENCY", "8")))
+    parser.add_argument("--base-url", default=RAW_BASE_URL, help="Raw file endpoint")
+    parser.add_argument("--mirrors", default=os.getenv("GIT_MIRRORS_DIR"),
+                        help="Read files from the local git clones or mirrors in this directory")
+    parser.add_argument("--queue-size", type=int, default=256, help="Records buffered between two stages")
+    parser.add_argument("--report-every", type=int, default=100, help="Log running metrics every N answers")
+    parser.add_argument("--bootstrap", type=int, default=1000, help="Bootstrap replicates for the final report")
+    parser.add_argument("--chunk", action="store_true",
+                        help="Split snippets that overflow the context window at method boundaries instead of truncating")
+    parser.add_argument("--no-cache", action="store_true", help="Do not read or write the response cache")
+    parser.add_argument("--samples", type=int, default=1,
+                        help="Self-consistency: vote over up to this many sampled answers per snippet")
+    gpt4_arguments = parser.add_argument_group("gpt4 backend")
+    gpt4_arguments.add_argument("--concurrency", type=int, default=8, help="Maximum requests in flight")
+    gpt4_arguments.add_argument("--tpm", type=int, default=None, help="Tokens-per-minute budget of the API key")
+    add_few_shot_arguments(gpt4_arguments)
+    llama_arguments = parser.add_argument_group("llama backend")
+    llama_arguments.add_argument("--model", default=None, help="Hugging Face model id or local path")
+    llama_arguments.add_argument("--batch-size", type=int, default=8, help="Snippets per generation batch")
+    llama_arguments.add_argument("--max-batch-tokens", type=int, default=32768,
+                                 help="Upper bound on padded prompt + generated tokens per batch")
+    llama_arguments.add_argument("--window", type=int, default=64, help="Snippets bucketed together at most")
+    llama_arguments.add_argument("--max-wait", type=float, default=1.0,
+                                 help="Seconds to wait for a window to fill before running a partial one")
+    llama_arguments.add_argument("--constrained", action="store_true",
+                                 help="Score the 16 valid answers instead of generating free text")
+    add_telemetry_arguments(parser)
+    args = parser.parse_args()
+    if args.constrained and args.samples > 1:
+        parser.error("--samples votes over sampled answers and cannot be combined with --constrained")
+    configure(args.trace, args.metrics_port)
+
+    results_filepath = shard_path(args.output or f"{args.backend}_pipeline_results.json", args.shard)
+    run(args.input, results_filepath, shard_path(args.dataset_output, args.shard), backend=args.backend,
+        shard=args.shard, smells=args.smells, severities=args.severities,
+        fetch_concurrency=args.fetch_concurrency, base_url=args.base_url, mirrors_dir=args.mirrors,
+        queue_size=args.queue_size,
+        report_every=args.report_every, n_bootstrap=args.bootstrap,
+        chunk=args.chunk, use_cache=not args.no_cache, samples=args.samples,
+        concurrency=args.concurrency, tokens_per_minute=args.tpm, few_shot_index=args.few_shot_index,
+        few_shot_k=args.few_shot_k, few_shot_tokens=args.few_shot_tokens,
+        model=args.model, batch_size=args.batch_size, max_batch_tokens=args.max_batch_tokens, window=args.window,
+        max_wait=args.max_wait, constrained=args.constrained)
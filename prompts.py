@@ -0,0 +1,84 @@
+import functools
+
+
+# --------------------------------- Few shot prompts ----------------------------------#
+examples = [
+{
+        "code_snippet": "  @Override\n  public boolean incrementToken() throws IOException {\n    for(;;) {\n\n      if (!remainingTokens.isEmpty()) {\n        // clearAttributes();  // not currently necessary\n        restoreState(remainingTokens.removeFirst());\n        return true;\n      }\n\n      if (!input.incrementToken()) return false;\n\n      int len = termAtt.length();\n      if (len==0) return true; // pass through zero length terms\n      \n      int firstAlternativeIncrement = inject ? 0 : posAtt.getPositionIncrement();\n\n      String v = termAtt.toString();\n      String primaryPhoneticValue = encoder.doubleMetaphone(v);\n      String alternatePhoneticValue = encoder.doubleMetaphone(v, true);\n\n      // a flag to lazily save state if needed... this avoids a save/restore when only\n      // one token will be generated.\n      boolean saveState=inject;\n\n      if (primaryPhoneticValue!=null && primaryPhoneticValue.length() > 0 && !primaryPhoneticValue.equals(v)) {\n        if (saveState) {\n          remainingTokens.addLast(captureState());\n        }\n        posAtt.setPositionIncrement( firstAlternativeIncrement );\n        firstAlternativeIncrement = 0;\n        termAtt.setEmpty().append(primaryPhoneticValue);\n        saveState = true;\n      }\n\n      if (alternatePhoneticValue!=null && alternatePhoneticValue.length() > 0\n              && !alternatePhoneticValue.equals(primaryPhoneticValue)\n              && !primaryPhoneticValue.equals(v)) {\n        if (saveState) {\n          remainingTokens.addLast(captureState());\n          saveState = false;\n        }\n        posAtt.setPositionIncrement( firstAlternativeIncrement );\n        termAtt.setEmpty().append(alternatePhoneticValue);\n        saveState = true;\n      }\n\n      // Just one token to return, so no need to capture/restore\n      // any state, simply return it.\n      if (remainingTokens.isEmpty()) {\n        return true;\n      }\n\n      if (saveState) {\n        remainingTokens.addLast(captureState());\n      }\n    }\n  }",
+        "smell": "long_method",
+        "severity": "moderate"
+    },
+    {
+        "code_snippet": "@Entity\npublic class Car2 {\n  @Id\n  private String numberPlate;\n  \n  private String colour;\n  \n  private int engineSize;\n  \n  private int numberOfSeats;\n\n  public String getNumberPlate() {\n    return numberPlate;\n  }\n\n  public void setNumberPlate(String numberPlate) {\n    this.numberPlate = numberPlate;\n  }\n\n  public String getColour() {\n    return colour;\n  }\n\n  public void setColour(String colour) {\n    this.colour = colour;\n  }\n\n  public int getEngineSize() {\n    return engineSize;\n  }\n\n  public void setEngineSize(int engineSize) {\n    this.engineSize = engineSize;\n  }\n\n  public int getNumberOfSeats() {\n    return numberOfSeats;\n  }\n\n  public void setNumberOfSeats(int numberOfSeats) {\n    this.numberOfSeats = numberOfSeats;\n  }\n  \n  \n}",
+        "smell": "data_class",
+        "severity": "moderate"
+    },
+    {
+        "code_snippet": "@Override\n      public void read(org.apache.thrift.protocol.TProtocol prot, cancelCompaction_args struct) throws org.apache.thrift.TException {\n        org.apache.thrift.protocol.TTupleProtocol iprot = (org.apache.thrift.protocol.TTupleProtocol) prot;\n        java.util.BitSet incoming = iprot.readBitSet(2);\n        if (incoming.get(0)) {\n          struct.login = iprot.readBinary();\n          struct.setLoginIsSet(true);\n        }\n        if (incoming.get(1)) {\n          struct.tableName = iprot.readString();\n          struct.setTableNameIsSet(true);\n        }\n      }",
+        "smell": "feature_envy",
+        "severity": "minor"
+    }
+]
+
+FEW_SHOT_INSTRUCTIONS = (
+    "You are a code analysis assistant. Below are examples of code snippets with identified code smells and severity.\n"
+    "Use this information to analyze the next code snippet and identify any code smell between:\n"
+    '"feature_envy", "long_method", "blob", "data_class". Additionally, rate the severity of the code smell as: "none", "minor", "moderate", or "severe."\n\n'
+)
+
+
+def format_example(number, example):
+    return (f"Example {number}:\n"
+            f"Code snippet:\n```\n{example['code_snippet']}\n```\n"
+            f"Smell: {example['smell']}, Severity: {example['severity']}\n\n")
+
+
+def few_shot_prompt(examples):
+    prompt = FEW_SHOT_INSTRUCTIONS
+    for i, example in enumerate(examples, start=1):
+        prompt += format_example(i, example)
+    return prompt
+
+
+class PromptTemplate:
+    """A prompt made of a static prefix, the code snippet and a static suffix.
+
+    The prefix is built once and shared by every request, so it can also be
+    encoded and prefilled once (see `llama.PrefixCache`).
+    """
+
+    def __init__(self, prefix, suffix=""):
+        self.prefix = prefix
+        self.suffix = suffix
+
+    def render(self, code_snippet):
+        return self.prefix + code_snippet + self.suffix
+
+
+@functools.lru_cache(maxsize=None)
+def gpt_system_prompt():
+    """The few-shot system prompt sent with every GPT request, built only once."""
+    return few_shot_prompt(examples)
+
+
+# The instructions of llama.py's prompt, split around the snippet. llama.PrefixCache
+# reuses the prefix's KV cache only for prompts whose own tokens start with it.
+LLAMA_TEMPLATE = PromptTemplate(
+    prefix="""
+    You are a code analysis assistant. Please analyze the following code snippet and identify any code smell between:
+    "feature_envy", "long_method", "blob", "data_class". 
+    Additionally, rate the severity of the code smell as: "none", "minor", "moderate", or "severe."
+
+    Code snippet:
+    ```
+""",
+    suffix="""
+    ```
+
+    Provide your response in the exact format: "Smell: <name>, Severity: <severity>"
+    """,
+)
+
+
+def llama_prompt(code_snippet):
+    return LLAMA_TEMPLATE.render("    " + code_snippet)
@@ -0,0 +1,62 @@
+import hashlib
+import json
+import logging
+import threading
+
+import diskcache
+
+DEFAULT_CACHE_DIR = ".response_cache"
+DEFAULT_SIZE_LIMIT = 2 * 1024 ** 3
+
+response_cache = None
+
+
+def cache_key(model, prompt, temperature, max_tokens, **params):
+    """Key of a model response: model id, a hash of the prompt (a string or chat
+    messages) and every decoding parameter that changes the output."""
+    prompt_hash = hashlib.sha256(json.dumps(prompt, sort_keys=True).encode("utf-8")).hexdigest()
+    extra = json.dumps(params, sort_keys=True) if params else ""
+    return f"{model}|{prompt_hash}|{temperature}|{max_tokens}|{extra}"
+
+
+class ResponseCache:
+    """Disk-backed cache of model responses, shared by gpt4.py and llama.py.
+
+    Entries are evicted least-recently-used once the cache outgrows `size_limit` bytes.
+    """
+
+    def __init__(self, directory=DEFAULT_CACHE_DIR, size_limit=DEFAULT_SIZE_LIMIT):
+        self.cache = diskcache.Cache(directory, size_limit=size_limit, eviction_policy="least-recently-used")
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    def get(self, model, prompt, temperature, max_tokens, **params):
+        value = self.cache.get(cache_key(model, prompt, temperature, max_tokens, **params))
+        with self.lock:
+            if value is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+        return value
+
+    def set(self, model, prompt, temperature, max_tokens, value, **params):
+        if value is not None:
+            self.cache.set(cache_key(model, prompt, temperature, max_tokens, **params), value)
+
+    def log_stats(self):
+        total = self.hits + self.misses
+        if total:
+            logging.info(f"Response cache: {self.hits}/{total} hits ({self.hits / total:.1%}), "
+                         f"{len(self.cache)} entries, {self.cache.volume() / 1024 ** 2:.1f} MiB on disk")
+
+    def close(self):
+        self.cache.close()
+
+
+def get_response_cache():
+    """The process-wide cache in DEFAULT_CACHE_DIR, opened on first use."""
+    global response_cache
+    if response_cache is None:
+        response_cache = ResponseCache()
+    return response_cache
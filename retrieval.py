@@ -0,0 +1,192 @@
+"""Few-shot examples picked per snippet from the labeled corpus instead of a fixed list.
+
+Every short labeled snippet is embedded once as a hashed TF-IDF vector over its
+code tokens (identifiers split into their camelCase / snake_case words, plus
+token bigrams), so no model or network is needed. The vectors are saved as a
+.npy matrix and memory-mapped at query time; a query is a single
+matrix-vector product followed by picking the nearest examples that fit the
+prompt's token budget.
+
+    python retrieval.py --input MLCQCodeSmellSamples.json --index few_shot_index
+"""
+import argparse
+import hashlib
+import json
+import logging
+import os
+import re
+import threading
+import zlib
+
+import numpy as np
+
+from dataset import iter_records
+
+DEFAULT_INDEX_DIR = "few_shot_index"
+DEFAULT_DIMENSIONS = 1024
+# Longest snippet, in code tokens, worth keeping as an example.
+DEFAULT_MAX_EXAMPLE_TOKENS = 300
+DEFAULT_FEW_SHOT_K = 3
+DEFAULT_FEW_SHOT_TOKENS = 1200
+# Nearest examples looked at before giving up on filling the token budget.
+CANDIDATES = 64
+
+CODE_TOKEN = re.compile(r"[A-Za-z_$][A-Za-z0-9_$]*|\d+|\S")
+IDENTIFIER_WORD = re.compile(r"[A-Z]+(?![a-z])|[A-Z]?[a-z]+|\d+")
+
+
+def code_tokens(code):
+    return CODE_TOKEN.findall(code)
+
+
+def features(code):
+    """Words of the identifiers, whole identifiers and punctuation, plus bigrams of consecutive tokens."""
+    raw_tokens = code_tokens(code)
+    tokens = [token.lower() for token in raw_tokens]
+    words = []
+    for token in raw_tokens:
+        parts = IDENTIFIER_WORD.findall(token)
+        words.extend(part.lower() for part in parts)
+        if len(parts) != 1:
+            words.append(token.lower())
+    return words + [f"{a} {b}" for a, b in zip(tokens, tokens[1:])]
+
+
+def hashed_counts(code, dimensions):
+    """(feature indices, counts) of a snippet under the hashing trick."""
+    indices = [zlib.crc32(feature.encode("utf-8")) % dimensions for feature in features(code)]
+    return np.unique(np.array(indices, dtype=np.int64), return_counts=True)
+
+
+def snippet_hash(code):
+    """Identifies a snippet labeled several times (MLCQ has several reviewers per sample)."""
+    return int.from_bytes(hashlib.sha1(code.encode("utf-8")).digest()[:8], "little", signed=True)
+
+
+def tf_idf(indices, counts, idf):
+    vector = np.zeros(len(idf), dtype=np.float32)
+    vector[indices] = (1 + np.log(counts)) * idf[indices]
+    norm = np.linalg.norm(vector)
+    return vector / norm if norm else vector
+
+
+def build_index(dataset_path, index_dir=DEFAULT_INDEX_DIR, dimensions=DEFAULT_DIMENSIONS,
+                max_example_tokens=DEFAULT_MAX_EXAMPLE_TOKENS):
+    """Embed every labeled snippet of at most `max_example_tokens` code tokens into `index_dir`.
+
+    The directory holds the vectors, idf weights, unique ids and snippet hashes
+    as .npy files, and the examples themselves as JSON lines with their offsets.
+    """
+    os.makedirs(index_dir, exist_ok=True)
+    sparse, ids, hashes, offsets = [], [], [], []
+    document_frequency = np.zeros(dimensions, dtype=np.int64)
+    with open(os.path.join(index_dir, "examples.jsonl"), "wb") as f:
+        for record in iter_records(dataset_path):
+            code = record.get("code_snippet")
+            if not code or len(code_tokens(code)) > max_example_tokens:
+                continue
+            indices, counts = hashed_counts(code, dimensions)
+            document_frequency[indices] += 1
+            sparse.append((indices, counts))
+            ids.append(record["unique_id"])
+            hashes.append(snippet_hash(code))
+            offsets.append(f.tell())
+            example = {"unique_id": record["unique_id"], "code_snippet": code,
+                       "smell": record["smell"], "severity": record["severity"]}
+            f.write(json.dumps(example).encode("utf-8") + b"\n")
+
+    idf = (np.log((1 + len(sparse)) / (1 + document_frequency)) + 1).astype(np.float32)
+    vectors = np.lib.format.open_memmap(os.path.join(index_dir, "vectors.npy"), mode="w+",
+                                        dtype=np.float32, shape=(len(sparse), dimensions))
+    for row, (indices, counts) in enumerate(sparse):
+        vectors[row] = tf_idf(indices, counts, idf)
+    vectors.flush()
+    del vectors
+    np.save(os.path.join(index_dir, "idf.npy"), idf)
+    np.save(os.path.join(index_dir, "ids.npy"), np.array(ids))
+    np.save(os.path.join(index_dir, "hashes.npy"), np.array(hashes, dtype=np.int64))
+    np.save(os.path.join(index_dir, "offsets.npy"), np.array(offsets, dtype=np.int64))
+    logging.info(f"Indexed {len(sparse)} examples of at most {max_example_tokens} code tokens into {index_dir}")
+    return len(sparse)
+
+
+class FewShotIndex:
+    """Memory-mapped index built by `build_index`, answering nearest-example queries."""
+
+    def __init__(self, index_dir=DEFAULT_INDEX_DIR):
+        def load(name):
+            return np.load(os.path.join(index_dir, f"{name}.npy"), mmap_mode="r")
+
+        self.vectors = load("vectors")
+        self.idf = np.asarray(load("idf"))
+        self.ids = load("ids")
+        self.hashes = load("hashes")
+        self.offsets = load("offsets")
+        self.examples = open(os.path.join(index_dir, "examples.jsonl"), "rb")
+        self.lock = threading.Lock()
+        self.costs = {}
+
+    def __len__(self):
+        return len(self.ids)
+
+    def embed(self, code):
+        return tf_idf(*hashed_counts(code, len(self.idf)), self.idf)
+
+    def example(self, row):
+        with self.lock:
+            self.examples.seek(self.offsets[row])
+            return json.loads(self.examples.readline())
+
+    def nearest(self, code, k, token_budget, cost, exclude_id=None):
+        """Up to `k` examples most similar to `code`, most similar first, whose
+        `cost(example)` (memoized per example) adds up to at most `token_budget`.
+
+        The example labeled `exclude_id` and any copy of `code` itself are skipped,
+        as are repeated snippets, so a labeled query never sees its own answer.
+        """
+        if k <= 0 or not len(self):
+            return []
+        scores = self.vectors @ self.embed(code)
+        query_hash = snippet_hash(code)
+        candidates = min(CANDIDATES, len(scores))
+        top = np.argpartition(-scores, candidates - 1)[:candidates]
+        chosen, seen, used = [], {query_hash}, 0
+        for row in top[np.argsort(-scores[top], kind="stable")]:
+            if self.ids[row] == exclude_id or self.hashes[row] in seen:
+                continue
+            example = None
+            if row not in self.costs:
+                example = self.example(row)
+                self.costs[row] = cost(example)
+            if used + self.costs[row] > token_budget:
+                continue
+            chosen.append(example or self.example(row))
+            seen.add(self.hashes[row])
+            used += self.costs[row]
+            if len(chosen) == k:
+                break
+        return chosen
+
+    def close(self):
+        self.examples.close()
+
+
+def add_few_shot_arguments(parser):
+    parser.add_argument("--few-shot-index", default=os.getenv("FEW_SHOT_INDEX"),
+                        help="Index built by retrieval.py to pick the nearest examples from instead of the fixed ones")
+    parser.add_argument("--few-shot-k", type=int, default=DEFAULT_FEW_SHOT_K, help="Examples per request")
+    parser.add_argument("--few-shot-tokens", type=int, default=DEFAULT_FEW_SHOT_TOKENS,
+                        help="Token budget of the retrieved examples")
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(message)s")
+    parser = argparse.ArgumentParser(description="Build the few-shot example index of a labeled dataset")
+    parser.add_argument("--input", default="MLCQCodeSmellSamples.json",
+                        help="Labeled snippets, as a JSON array or JSONL file")
+    parser.add_argument("--index", default=DEFAULT_INDEX_DIR, help="Directory to write the index to")
+    parser.add_argument("--dimensions", type=int, default=DEFAULT_DIMENSIONS, help="Size of the hashed vectors")
+    parser.add_argument("--max-example-tokens", type=int, default=DEFAULT_MAX_EXAMPLE_TOKENS,
+                        help="Leave out snippets longer than this many code tokens")
+    args = parser.parse_args()
+    build_index(args.input, args.index, args.dimensions, args.max_example_tokens)
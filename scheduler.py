@@ -0,0 +1,164 @@
+import asyncio
+import logging
+import random
+import time
+from collections import deque
+
+from telemetry import count
+
+
+class AsyncTokenBucket:
+    """Token bucket for budgets such as tokens-per-minute, shared by asyncio tasks."""
+
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.last_refill = time.monotonic()
+        self.lock = asyncio.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.last_refill) * self.rate)
+        self.last_refill = now
+
+    async def acquire(self, tokens):
+        # A request larger than the whole bucket waits for a full bucket instead of forever.
+        tokens = min(tokens, self.capacity)
+        async with self.lock:
+            while True:
+                self._refill()
+                if self.tokens >= tokens:
+                    self.tokens -= tokens
+                    return
+                await asyncio.sleep((tokens - self.tokens) / self.rate)
+
+
+async def aiterate(items):
+    """Iterate a sync or async iterable from async code."""
+    if hasattr(items, "__aiter__"):
+        async for item in items:
+            yield item
+    else:
+        for item in items:
+            yield item
+
+
+class AdaptiveScheduler:
+    """Runs coroutines with an AIMD-adjusted number of requests in flight.
+
+    The concurrency limit grows by one per limit's worth of successes and halves
+    whenever the server answers with one of `rate_limit_errors`. Calls failing
+    with one of `transient_errors` (server errors, dropped connections) are
+    retried with the same backoff but leave the limit alone. With
+    `tokens_per_minute` set, each call also waits for its estimated token cost.
+    """
+
+    def __init__(self, max_concurrency=16, min_concurrency=1, initial_concurrency=None,
+                 tokens_per_minute=None, rate_limit_errors=(), transient_errors=(), retries=10, backoff_base=5):
+        self.max_concurrency = max_concurrency
+        self.min_concurrency = min_concurrency
+        self.limit = float(initial_concurrency or max_concurrency)
+        self.tokens_per_minute = tokens_per_minute
+        self.rate_limit_errors = tuple(rate_limit_errors)
+        self.transient_errors = tuple(transient_errors)
+        self.retries = retries
+        self.backoff_base = backoff_base
+        self.in_flight = 0
+        self.last_decrease = 0.0
+        self.rate_limited = 0
+        self.token_bucket = None
+        self.condition = None
+
+    def _ensure_primitives(self):
+        # Created lazily so they bind to the event loop that actually runs the jobs.
+        if self.condition is None:
+            self.condition = asyncio.Condition()
+            if self.tokens_per_minute:
+                self.token_bucket = AsyncTokenBucket(self.tokens_per_minute / 60, self.tokens_per_minute)
+
+    async def _acquire_slot(self):
+        async with self.condition:
+            while self.in_flight >= int(self.limit):
+                await self.condition.wait()
+            self.in_flight += 1
+
+    async def _release_slot(self):
+        async with self.condition:
+            self.in_flight -= 1
+            self.condition.notify_all()
+
+    def on_success(self):
+        self.limit = min(self.max_concurrency, self.limit + 1 / self.limit)
+
+    def on_rate_limit(self):
+        self.rate_limited += 1
+        now = time.monotonic()
+        # Requests already in flight when the limit was cut will fail too, only
+        # back off once per burst of errors.
+        if now - self.last_decrease < 1.0:
+            return
+        self.last_decrease = now
+        self.limit = max(self.min_concurrency, self.limit / 2)
+        logging.warning(f"Rate limited, concurrency reduced to {int(self.limit)}")
+
+    async def charge(self, cost):
+        """Wait until `cost` tokens fit the tokens-per-minute budget, for calls that send several requests."""
+        self._ensure_primitives()
+        if self.token_bucket is not None and cost:
+            await self.token_bucket.acquire(cost)
+
+    async def run(self, fn, item, cost=0):
+        """Call `await fn(item)`, retrying on rate-limit and transient errors. Returns None if every attempt fails."""
+        self._ensure_primitives()
+        for attempt in range(self.retries):
+            if self.token_bucket is not None and cost:
+                await self.token_bucket.acquire(cost)
+            await self._acquire_slot()
+            try:
+                result = await fn(item)
+            except self.rate_limit_errors:
+                count("rate_limited")
+                self.on_rate_limit()
+                reason = "Rate limit exceeded"
+            except self.transient_errors as e:
+                count("transient_errors")
+                reason = f"Request failed ({type(e).__name__})"
+            else:
+                self.on_success()
+                return result
+            finally:
+                await self._release_slot()
+
+            wait_time = min(60, (2 ** attempt) * self.backoff_base) * random.uniform(0.5, 1.0)
+            logging.warning(f"{reason}. Retrying in {wait_time:.1f} seconds.")
+            count("retries")
+            count("backoff_seconds", wait_time)
+            await asyncio.sleep(wait_time)
+
+        logging.error("Failed to complete request after multiple retries.")
+        return None
+
+    async def map_ordered(self, fn, items, cost_fn=None):
+        """Async generator applying `fn` to `items` (a sync or async iterable), yielding
+        (item, result) in input order.
+
+        Up to 4x the maximum concurrency jobs are queued ahead, so a slow item only
+        holds back the output, not the requests behind it.
+        """
+        self._ensure_primitives()
+        window = self.max_concurrency * 4
+        pending = deque()
+        async for item in aiterate(items):
+            # With a slow async source, hand over what is already done before waiting for more.
+            while pending and pending[0][1].done():
+                done_item, future = pending.popleft()
+                yield done_item, future.result()
+            cost = cost_fn(item) if cost_fn else 0
+            pending.append((item, asyncio.ensure_future(self.run(fn, item, cost))))
+            if len(pending) >= window:
+                item, future = pending.popleft()
+                yield item, await future
+        while pending:
+            item, future = pending.popleft()
+            yield item, await future
@@ -0,0 +1,146 @@
+import json
+import logging
+import os
+import tempfile
+
+from telemetry import span
+
+
+def jsonl_path_for(json_path):
+    """Working append-only file that backs a JSON-array output, e.g. results.json -> results.jsonl."""
+    return os.path.splitext(json_path)[0] + ".jsonl"
+
+
+def drop_torn_line(path, block_size=1 << 16):
+    """Truncate a file that does not end in a newline back to its last complete line."""
+    if not os.path.exists(path):
+        return
+    with open(path, "rb+") as f:
+        end = f.seek(0, os.SEEK_END)
+        position = end
+        while position > 0:
+            start = max(0, position - block_size)
+            f.seek(start)
+            block = f.read(position - start)
+            newline = block.rfind(b"\n")
+            if newline != -1:
+                position = start + newline + 1
+                break
+            position = start
+        if position < end:
+            logging.warning(f"Dropping a truncated last line of {end - position} bytes in {path}")
+            f.truncate(position)
+
+
+class JsonlWriter:
+    """Append-only JSONL writer. Each batch is flushed and fsync'd before returning,
+    so a crash can at worst leave a truncated last line. That line is dropped when
+    the file is opened again, so the next batch starts on a line of its own."""
+
+    def __init__(self, path):
+        self.path = path
+        drop_torn_line(path)
+        self.file = open(path, "a", encoding="utf-8")
+
+    def write_batch(self, records):
+        if not records:
+            return
+        with span("persist", records=len(records)):
+            self.file.write("".join(json.dumps(record) + "\n" for record in records))
+            self.file.flush()
+            os.fsync(self.file.fileno())
+
+    def close(self):
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def read_jsonl(path):
+    """Lazily yield records from a JSONL file, skipping lines left corrupt by a crash."""
+    if not os.path.exists(path):
+        return
+    with open(path, "r", encoding="utf-8") as f:
+        for line_number, line in enumerate(f, start=1):
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                yield json.loads(line)
+            except json.JSONDecodeError:
+                logging.warning(f"Skipping corrupt line {line_number} in {path}")
+
+
+def _atomic_write(path, write_fn):
+    directory = os.path.dirname(os.path.abspath(path))
+    fd, tmp_path = tempfile.mkstemp(dir=directory, suffix=".tmp")
+    try:
+        with os.fdopen(fd, "w", encoding="utf-8") as f:
+            write_fn(f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.remove(tmp_path)
+        raise
+
+
+def compact_jsonl(path, key=None):
+    """Rewrite `path` without corrupt lines and, if `key` is given, keep only the last
+    record for each key. The new file replaces the old one atomically."""
+    if key is None:
+        records = list(read_jsonl(path))
+    else:
+        records = list({record[key]: record for record in read_jsonl(path)}.values())
+
+    def write(f):
+        for record in records:
+            f.write(json.dumps(record) + "\n")
+
+    _atomic_write(path, write)
+    return len(records)
+
+
+def export_json_array(jsonl_path, json_path, indent=4):
+    """Stream a JSONL file into a JSON array file, replacing `json_path` atomically."""
+    pad = " " * indent if indent else ""
+
+    def write(f):
+        f.write("[")
+        for i, record in enumerate(read_jsonl(jsonl_path)):
+            f.write(",\n" if i else "\n")
+            body = json.dumps(record, indent=indent)
+            f.write(pad + body.replace("\n", "\n" + pad) if indent else body)
+        f.write("\n]\n")
+
+    _atomic_write(json_path, write)
+
+
+def save_results(results, writer):
+    writer.write_batch(results)
+
+
+def load_existing_results(filepath):
+    """Results already computed for `filepath`, read from its JSONL log."""
+    jsonl_filepath = jsonl_path_for(filepath)
+    if os.path.exists(jsonl_filepath):
+        return list(read_jsonl(jsonl_filepath))
+    if os.path.exists(filepath):
+        with open(filepath, "r") as file:
+            results = json.load(file)
+        # Seed the append-only log from a results file written before it existed.
+        with JsonlWriter(jsonl_filepath) as writer:
+            writer.write_batch(results)
+        return results
+    return []
+
+
+def export_results(filepath):
+    """Merge the JSONL log by unique_id and export it as the JSON array `filepath`."""
+    jsonl_filepath = jsonl_path_for(filepath)
+    compact_jsonl(jsonl_filepath, key="unique_id")
+    export_json_array(jsonl_filepath, filepath)
@@ -0,0 +1,242 @@
+"""Per-stage timing spans and counters for the pipeline.
+
+Every script records spans for the stages an item goes through (fetch, tokenize,
+retrieve, prompt_build, prefill, model_call, parse, persist) and counters for tokens,
+retries and backoff. Spans may nest, e.g. prompt_build includes the tokenize
+span of the truncation it performs. Aggregates are always kept in memory; with a
+trace file each span is also appended to it as one JSON line, and a Prometheus
+text endpoint can serve the aggregates while the run is going.
+
+Both are switched on with `--trace` / `--metrics-port` on the scripts, or the
+PIPELINE_TRACE / PIPELINE_METRICS_PORT environment variables. A trace can be
+summarised afterwards with `python telemetry.py run.trace.jsonl`.
+"""
+import argparse
+import atexit
+import http.server
+import json
+import logging
+import os
+import threading
+import time
+from collections import defaultdict, deque
+from contextlib import contextmanager
+
+import numpy as np
+
+# Durations kept per stage for the percentiles; sums and counts are exact.
+RESERVOIR_SIZE = 10000
+TRACE_FLUSH_EVERY = 1000
+
+telemetry = None
+
+
+class StageStats:
+
+    def __init__(self):
+        self.count = 0
+        self.errors = 0
+        self.total = 0.0
+        self.recent = deque(maxlen=RESERVOIR_SIZE)
+
+    def add(self, seconds, error=False):
+        self.count += 1
+        self.errors += error
+        self.total += seconds
+        self.recent.append(seconds)
+
+    def summary(self):
+        recent = np.array(self.recent)
+        p50, p99 = np.percentile(recent, [50, 99]) if len(recent) else (0.0, 0.0)
+        return {"count": self.count, "errors": self.errors, "total_seconds": self.total,
+                "mean_ms": 1000 * self.total / self.count if self.count else 0.0,
+                "p50_ms": 1000 * float(p50), "p99_ms": 1000 * float(p99)}
+
+
+class Telemetry:
+    """Thread-safe collector of spans and counters, optionally traced to `trace_path`."""
+
+    def __init__(self, trace_path=None, metrics_port=None):
+        self.lock = threading.Lock()
+        self.started = time.time()
+        self.stages = defaultdict(StageStats)
+        self.counters = defaultdict(float)
+        self.trace_path = trace_path
+        self.trace = open(trace_path, "a", encoding="utf-8") if trace_path else None
+        self.buffered = 0
+        self.server = serve_metrics(self, metrics_port) if metrics_port else None
+        if self.trace or self.server:
+            atexit.register(self.close)
+
+    @contextmanager
+    def span(self, stage, **attrs):
+        """Time the enclosed block as one `stage` span. The yielded dict takes extra
+        attributes (token counts, batch size...) that go to the trace."""
+        start = time.time()
+        began = time.perf_counter()
+        error = None
+        try:
+            yield attrs
+        except BaseException as e:
+            error = type(e).__name__
+            raise
+        finally:
+            self.record(stage, time.perf_counter() - began, start, error, attrs)
+
+    def record(self, stage, seconds, start=None, error=None, attrs=None):
+        with self.lock:
+            self.stages[stage].add(seconds, error is not None)
+            if self.trace is None:
+                return
+            event = {"ts": start if start is not None else time.time() - seconds, "stage": stage,
+                     "seconds": seconds, **(attrs or {})}
+            if error is not None:
+                event["error"] = error
+            self.trace.write(json.dumps(event) + "\n")
+            self.buffered += 1
+            if self.buffered >= TRACE_FLUSH_EVERY:
+                self.trace.flush()
+                self.buffered = 0
+
+    def count(self, name, value=1):
+        with self.lock:
+            self.counters[name] += value
+
+    def summary(self):
+        with self.lock:
+            return {
+                "wall_seconds": time.time() - self.started,
+                "stages": {stage: stats.summary() for stage, stats in self.stages.items()},
+                "counters": dict(self.counters),
+            }
+
+    def log_summary(self):
+        log_summary(self.summary())
+
+    def close(self):
+        if self.server is not None:
+            self.server.shutdown()
+            self.server.server_close()
+            self.server = None
+        if self.trace is None:
+            return
+        summary = self.summary()
+        with self.lock:
+            self.trace.close()
+            self.trace = None
+        with open(os.path.splitext(self.trace_path)[0] + ".summary.json", "w") as f:
+            json.dump(summary, f, indent=4)
+        log_summary(summary)
+
+
+def log_summary(summary):
+    logging.info(f"Telemetry over {summary['wall_seconds']:.1f}s:")
+    for stage, stats in sorted(summary["stages"].items(), key=lambda item: -item[1]["total_seconds"]):
+        logging.info(f"  {stage:<12} {stats['count']:>8} spans {stats['total_seconds']:>9.2f}s "
+                     f"mean {stats['mean_ms']:.1f} ms  p50 {stats['p50_ms']:.1f} ms  p99 {stats['p99_ms']:.1f} ms"
+                     + (f"  {stats['errors']} errors" if stats["errors"] else ""))
+    for name, value in sorted(summary["counters"].items()):
+        logging.info(f"  {name}: {value:g}")
+
+
+def render_prometheus(summary):
+    lines = ["# TYPE pipeline_stage_seconds summary"]
+    for stage, stats in summary["stages"].items():
+        lines.append(f'pipeline_stage_seconds{{stage="{stage}",quantile="0.5"}} {stats["p50_ms"] / 1000}')
+        lines.append(f'pipeline_stage_seconds{{stage="{stage}",quantile="0.99"}} {stats["p99_ms"] / 1000}')
+        lines.append(f'pipeline_stage_seconds_sum{{stage="{stage}"}} {stats["total_seconds"]}')
+        lines.append(f'pipeline_stage_seconds_count{{stage="{stage}"}} {stats["count"]}')
+    lines.append("# TYPE pipeline_stage_errors_total counter")
+    for stage, stats in summary["stages"].items():
+        lines.append(f'pipeline_stage_errors_total{{stage="{stage}"}} {stats["errors"]}')
+    lines.append("# TYPE pipeline_events_total counter")
+    for name, value in summary["counters"].items():
+        lines.append(f'pipeline_events_total{{name="{name}"}} {value}')
+    lines.append(f"pipeline_uptime_seconds {summary['wall_seconds']}")
+    return "\n".join(lines) + "\n"
+
+
+def serve_metrics(collector, port):
+    """Serve the collector's aggregates in the Prometheus text format on localhost:`port`/metrics."""
+
+    class MetricsHandler(http.server.BaseHTTPRequestHandler):
+
+        def log_message(self, format, *args):
+            pass
+
+        def do_GET(self):
+            if self.path.rstrip("/") not in ("", "/metrics"):
+                self.send_error(404)
+                return
+            body = render_prometheus(collector.summary()).encode("utf-8")
+            self.send_response(200)
+            self.send_header("Content-Type", "text/plain; version=0.0.4")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+    server = http.server.ThreadingHTTPServer(("127.0.0.1", port), MetricsHandler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    logging.info(f"Serving metrics on http://127.0.0.1:{server.server_port}/metrics")
+    return server
+
+
+def get_telemetry():
+    global telemetry
+    if telemetry is None:
+        port = os.getenv("PIPELINE_METRICS_PORT")
+        telemetry = Telemetry(os.getenv("PIPELINE_TRACE"), int(port) if port else None)
+    return telemetry
+
+
+def configure(trace_path=None, metrics_port=None):
+    """Replace the process-wide collector, e.g. from the --trace / --metrics-port arguments."""
+    global telemetry
+    if telemetry is not None:
+        telemetry.close()
+    telemetry = Telemetry(trace_path or os.getenv("PIPELINE_TRACE"), metrics_port)
+    return telemetry
+
+
+def span(stage, **attrs):
+    return get_telemetry().span(stage, **attrs)
+
+
+def count(name, value=1):
+    get_telemetry().count(name, value)
+
+
+def add_telemetry_arguments(parser):
+    parser.add_argument("--trace", default=None, help="Append per-item timing spans to this JSONL file")
+    parser.add_argument("--metrics-port", type=int, default=None,
+                        help="Serve live Prometheus metrics on this local port")
+
+
+def summarize_trace(trace_path):
+    """Rebuild the summary of a finished run from its trace file."""
+    collector = Telemetry()
+    first, last = None, None
+    with open(trace_path, "r", encoding="utf-8") as f:
+        for line in f:
+            try:
+                event = json.loads(line)
+            except json.JSONDecodeError:
+                continue
+            collector.stages[event["stage"]].add(event["seconds"], "error" in event)
+            first = event["ts"] if first is None else min(first, event["ts"])
+            last = event["ts"] + event["seconds"] if last is None else max(last, event["ts"] + event["seconds"])
+            for key, value in event.items():
+                if key.endswith("_tokens") and isinstance(value, (int, float)):
+                    collector.counters[key] += value
+    summary = collector.summary()
+    summary["wall_seconds"] = (last - first) if first is not None else 0.0
+    return summary
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(message)s")
+    parser = argparse.ArgumentParser(description="Summarise a pipeline trace file")
+    parser.add_argument("trace", help="JSONL trace written with --trace")
+    args = parser.parse_args()
+    log_summary(summarize_trace(args.trace))
@@ -0,0 +1,151 @@
+import re
+from collections import Counter
+
+SEVERITY_RANK = {"none": 0, "minor": 1, "moderate": 2, "severe": 3}
+
+VERDICT_PATTERN = re.compile(r"smell:\s*\"?([a-z_ ]+?)\"?\s*,\s*severity:\s*\"?([a-z]+)", re.IGNORECASE)
+
+# A class-like declaration before the first brace means the snippet's members sit one level deeper.
+TYPE_DECLARATION = re.compile(r"\b(class|interface|enum|record)\b")
+
+
+class TokenBudgeter:
+    """Measures and cuts text in real model tokens instead of characters."""
+
+    def __init__(self, encode, decode, context_window):
+        self.encode = encode
+        self.decode = decode
+        self.context_window = context_window
+
+    @classmethod
+    def for_tiktoken(cls, model, context_window):
+        import tiktoken
+        encoding = tiktoken.encoding_for_model(model)
+        return cls(lambda text: encoding.encode(text, disallowed_special=()), encoding.decode, context_window)
+
+    @classmethod
+    def for_tokenizer(cls, tokenizer, context_window):
+        return cls(lambda text: tokenizer(text, add_special_tokens=False)["input_ids"],
+                   lambda ids: tokenizer.decode(ids, skip_special_tokens=True), context_window)
+
+    def count(self, text):
+        return len(self.encode(text))
+
+    def snippet_budget(self, *fixed_texts, reserved=0):
+        """Tokens left for the snippet once the fixed parts of the prompt and `reserved`
+        (the completion budget, chat framing...) are accounted for."""
+        budget = self.context_window - reserved - sum(self.count(text) for text in fixed_texts)
+        if budget <= 0:
+            raise ValueError(f"A context window of {self.context_window} tokens leaves no room for the snippet")
+        return budget
+
+    def truncate(self, text, budget):
+        ids = self.encode(text)
+        if len(ids) <= budget:
+            return text
+        return self.decode(ids[:max(0, budget)])
+
+    def chunk(self, code, budget):
+        """Split code into pieces of at most `budget` tokens, cutting between methods.
+
+        Consecutive members are packed into the same chunk while they fit. A single
+        member larger than the budget is cut by lines, and a longer line into
+        consecutive slices of `budget` tokens.
+        """
+        if self.count(code) <= budget:
+            return [code]
+
+        chunks = []
+        current = []
+        current_tokens = 0
+        for segment in self._fit_segments(split_methods(code), budget):
+            tokens = self.count(segment)
+            if current and current_tokens + tokens > budget:
+                chunks.append("\n".join(current))
+                current, current_tokens = [], 0
+            current.append(segment)
+            current_tokens += tokens + 1
+        if current:
+            chunks.append("\n".join(current))
+        return chunks
+
+    def _fit_segments(self, segments, budget):
+        for segment in segments:
+            if self.count(segment) <= budget:
+                yield segment
+                continue
+            for line in segment.split("\n"):
+                ids = self.encode(line)
+                if len(ids) <= budget:
+                    yield line
+                    continue
+                step = max(1, budget)
+                for start in range(0, len(ids), step):
+                    yield self.decode(ids[start:start + step])
+
+
+def brace_delta(line):
+    """Net brace depth change of a line, ignoring braces in strings, chars and comments."""
+    line = re.sub(r'"(?:\\.|[^"\\])*"|\'(?:\\.|[^\'\\])*\'', "", line)
+    line = re.sub(r"//.*|/\*.*?\*/", "", line)
+    return line.count("{") - line.count("}")
+
+
+def split_methods(code):
+    """Split a Java snippet into top-level members (methods, nested types, fields).
+
+    Members of a class are the blocks that close back to the class body depth.
+    A class header forms a segment of its own, the closing brace joins the last
+    member, and comments or annotations stay attached to the member below them.
+    """
+    first_brace = code.find("{")
+    member_depth = 1 if first_brace != -1 and TYPE_DECLARATION.search(code[:first_brace]) else 0
+
+    segments = []
+    current = []
+    depth = 0
+    for line in code.split("\n"):
+        before = depth
+        depth += brace_delta(line)
+        current.append(line)
+
+        if before < member_depth <= depth:
+            # End of the class header.
+            segments.append("\n".join(current))
+            current = []
+        elif depth == member_depth and (before > member_depth or line.rstrip().endswith(";")):
+            # A member block closed, or a field / abstract method declaration ended.
+            segments.append("\n".join(current))
+            current = []
+    rest = "\n".join(current)
+    if segments and not rest.replace("}", "").strip():
+        # Only the class's closing brace (or blank lines) left, keep it with the last member.
+        segments[-1] += "\n" + rest if rest.strip() else ""
+    elif rest:
+        segments.append(rest)
+    return segments
+
+
+def parse_verdict(output):
+    """The (smell, severity) pair of an answer, normalised like "long_method", "minor", or None."""
+    match = VERDICT_PATTERN.search(output) if output is not None else None
+    if match is None:
+        return None
+    return match.group(1).strip().lower().replace(" ", "_"), match.group(2).lower()
+
+
+def aggregate_verdicts(outputs):
+    """Merge the per-chunk answers for one snippet into a single "Smell: X, Severity: Y".
+
+    The most severe verdict wins; among equally severe ones, the most frequent smell.
+    Outputs without a verdict are ignored, and if none has one the first output is returned.
+    """
+    verdicts = [verdict for verdict in map(parse_verdict, outputs) if verdict is not None]
+
+    if not verdicts:
+        return next((output for output in outputs if output is not None), None)
+
+    worst = max(SEVERITY_RANK.get(severity, 0) for _, severity in verdicts)
+    candidates = [verdict for verdict in verdicts if SEVERITY_RANK.get(verdict[1], 0) == worst]
+    smell, severity = Counter(candidates).most_common(1)[0][0]
+    return f"Smell: {smell}, Severity: {severity}"
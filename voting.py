@@ -0,0 +1,101 @@
+"""Self-consistency: several sampled answers per snippet, reduced to a majority vote.
+
+Samples are drawn in rounds. The first round draws just enough for a majority
+(samples // 2 + 1); later, smaller rounds are only drawn for snippets whose vote
+is not settled yet, that is while the leading answer could still be overtaken
+by the samples left and is not significantly ahead of the runner-up under a
+one-sided sign test at `alpha`.
+"""
+from collections import Counter
+from math import comb
+
+from telemetry import count
+from token_budget import parse_verdict, aggregate_verdicts
+
+DEFAULT_ALPHA = 0.05
+INVALID_ANSWER = "invalid"
+
+
+def answer_key(output):
+    verdict = parse_verdict(output)
+    return f"Smell: {verdict[0]}, Severity: {verdict[1]}" if verdict else INVALID_ANSWER
+
+
+def tally(outputs):
+    return Counter(answer_key(output) for output in outputs)
+
+
+def sign_test(leader, runner_up):
+    """P(leader or more votes out of leader + runner_up) if both answers were equally likely."""
+    n = leader + runner_up
+    return sum(comb(n, i) for i in range(leader, n + 1)) / 2 ** n
+
+
+def is_settled(votes, remaining, alpha=DEFAULT_ALPHA):
+    leader, runner_up = ([votes_for for _, votes_for in votes.most_common(2)] + [0, 0])[:2]
+    if leader > runner_up + remaining:
+        return True
+    return sign_test(leader, runner_up) < alpha
+
+
+def next_round(outputs, samples, alpha=DEFAULT_ALPHA):
+    """How many more samples to draw given the `outputs` drawn so far, 0 once the vote is settled."""
+    drawn = len(outputs)
+    if drawn >= samples:
+        return 0
+    first = samples // 2 + 1
+    if drawn == 0:
+        return first
+    if is_settled(tally(outputs), samples - drawn, alpha):
+        return 0
+    return min(samples - drawn, max(1, (samples - first + 1) // 2))
+
+
+def majority(outputs):
+    """The winning answer and the vote distribution of a snippet's samples.
+
+    Invalid answers are counted in the distribution but never win, unless no
+    sample holds a valid answer, in which case the first output is returned.
+    """
+    votes = tally(outputs)
+    valid = [(answer, votes_for) for answer, votes_for in votes.most_common() if answer != INVALID_ANSWER]
+    answer = valid[0][0] if valid else next((output for output in outputs if output is not None), None)
+    return answer, dict(votes)
+
+
+def sample_until_settled(sample_fn, items, samples, alpha=DEFAULT_ALPHA):
+    """Outputs for each of `items`, drawn in rounds until every vote is settled.
+
+    `sample_fn(items, counts)` must return, for each item, a list of `counts[i]`
+    sampled outputs; each round is a single call over all unsettled items.
+    """
+    outputs = [[] for _ in items]
+    while True:
+        counts = [next_round(item_outputs, samples, alpha) for item_outputs in outputs]
+        pending = [i for i, round_size in enumerate(counts) if round_size]
+        if not pending:
+            break
+        drawn = sample_fn([items[i] for i in pending], [counts[i] for i in pending])
+        for i, new_outputs in zip(pending, drawn):
+            outputs[i].extend(new_outputs)
+    count("samples_skipped", sum(samples - len(item_outputs) for item_outputs in outputs))
+    return outputs
+
+
+def vote_chunks(chunk_outputs):
+    """Answer and vote distribution of a snippet whose chunks were each sampled several times.
+
+    Each chunk gets its majority answer, those are merged like single answers
+    (most severe wins) and the votes of all chunks are added up. Chunks whose
+    samples could not be drawn (None) are left out.
+    """
+    answers, votes = [], Counter()
+    for outputs in chunk_outputs:
+        if outputs is None:
+            continue
+        answer, chunk_votes = majority(outputs)
+        answers.append(answer)
+        votes.update(chunk_votes)
+    if not answers:
+        return None, None
+    return (aggregate_verdicts(answers) if len(answers) > 1 else answers[0]), dict(votes)